@@ -0,0 +1,368 @@
+import argparse
+import contextlib
+import io
+import json
+import computer_vision as cv
+from numpy import linalg as LA
+import numpy as np
+import pipeline as pl
+from scipy.spatial.transform import Rotation
+import sys
+import time
+
+
+class SyntheticFeatures:
+
+    def __init__(self, scene):
+        self.img_names = ['synthetic_{}.png'.format(i) for i in range(len(scene['pts']))]
+        self.pts = scene['pts']
+        self.des = scene['des']
+        self._indices = {}
+
+    def __len__(self):
+        return len(self.img_names)
+
+    def __getitem__(self, i):
+        return self.pts[i], self.des[i]
+
+    def index(self, i):
+        if i not in self._indices:
+            self._indices[i] = cv.build_flann_index(self.des[i])
+        return self._indices[i]
+
+
+def look_at(C, target=np.zeros(3), up=np.array([0, -1, 0])):
+    z = cv.normalize_vector(target - C)
+    x = cv.normalize_vector(np.cross(up, z))
+    y = np.cross(z, x)
+    R = np.array([x, y, z])
+    T = -R @ C
+    return R, T
+
+
+def generate_scene(n_cams, n_pts, noise_px=0.5, outlier_ratio=0.2, planar=False, focal=1000, img_size=(1600, 1200), n_distractors=0, seed=None):
+    rng = np.random.default_rng(seed)
+    w, h = img_size
+    K = np.array([[focal, 0, w/2], [0, focal, h/2], [0, 0, 1]], dtype=float)
+
+    # Points in a cube around the origin, or on a tilted plane through it
+    X = rng.uniform(-1, 1, (3, n_pts))
+    if planar:
+        X[2] = 0.3 * X[0] + 0.1 * X[1]
+
+    # Cameras on an arc facing the origin
+    radius = 4
+    angles = np.linspace(-0.4, 0.4, n_cams)
+    rots = []
+    trans = []
+    for a in angles:
+        C = radius * np.array([np.sin(a), 0.1 * rng.standard_normal(), -np.cos(a)])
+        R, T = look_at(C)
+        rots.append(R)
+        trans.append(T)
+    rots = np.array(rots)
+    trans = np.array(trans)
+
+    # Every point has a descriptor that is perturbed independently in each image
+    des_X = rng.uniform(0, 1, (n_pts, 128)).astype(np.float32) * 100
+
+    pts = []
+    des = []
+    pt_ids = []
+    outliers = []
+    for i in range(n_cams):
+        x = K @ (rots[i] @ X + trans[i][:,None])
+        depth = x[-1]
+        x = x[:2] / depth
+        visible = (depth > 0) & (x[0] >= 0) & (x[0] < w) & (x[1] >= 0) & (x[1] < h)
+        ids = np.flatnonzero(visible)
+        x = x[:,ids] + rng.normal(0, noise_px, (2, ids.size))
+
+        # Outliers keep the descriptor of their point but are moved to a random location
+        is_outlier = rng.random(ids.size) < outlier_ratio
+        x[:,is_outlier] = rng.uniform((0, 0), (w, h), (is_outlier.sum(), 2)).T
+        d = des_X[ids] + rng.normal(0, 2, (ids.size, 128)).astype(np.float32)
+
+        # Distractors are unmatched keypoints with random descriptors
+        x = np.concatenate((x, rng.uniform((0, 0), (w, h), (n_distractors, 2)).T), 1)
+        d = np.concatenate((d, rng.uniform(0, 100, (n_distractors, 128)).astype(np.float32)), 0)
+        ids = np.concatenate((ids, np.full(n_distractors, -1)))
+        is_outlier = np.concatenate((is_outlier, np.ones(n_distractors, dtype=bool)))
+
+        perm = rng.permutation(ids.size)
+        pts.append(x[:,perm])
+        des.append(d[perm])
+        pt_ids.append(ids[perm])
+        outliers.append(is_outlier[perm])
+
+    return {'K': K, 'rots': rots, 'trans': trans, 'X': X, 'pts': pts, 'des': des, 'pt_ids': pt_ids, 'outliers': outliers}
+
+
+def get_correspondences(scene, i, j):
+    # Ground truth correspondences between images i and j, including outlier observations
+    ids_i = scene['pt_ids'][i]
+    ids_j = scene['pt_ids'][j]
+    common, idx_i, idx_j = np.intersect1d(ids_i[ids_i >= 0], ids_j[ids_j >= 0], return_indices=True)
+    idx_i = np.flatnonzero(ids_i >= 0)[idx_i]
+    idx_j = np.flatnonzero(ids_j >= 0)[idx_j]
+    outliers = scene['outliers'][i][idx_i] | scene['outliers'][j][idx_j]
+    return common, idx_i, idx_j, outliers
+
+
+def normalize_points(K, pts):
+    return cv.dehomogenize(LA.inv(K) @ cv.homogenize(pts, multi=True))
+
+
+def compute_rotation_error(R_est, R_gt):
+    cos = (np.trace(R_est.T @ R_gt) - 1) / 2
+    return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+
+def compute_angle_error(v_est, v_gt):
+    cos = v_est @ v_gt / (LA.norm(v_est) * LA.norm(v_gt))
+    return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+
+def compute_camera_centers(rots, trans):
+    return np.array([-R.T @ T for R, T in zip(rots, trans)])
+
+
+def align_similarity(src, dst):
+    # Umeyama alignment of src onto dst, points along the rows
+    mu_src = src.mean(0)
+    mu_dst = dst.mean(0)
+    src_c = src - mu_src
+    dst_c = dst - mu_dst
+    U, S, VT = LA.svd(dst_c.T @ src_c / src.shape[0])
+    D = np.eye(3)
+    D[2,2] = np.sign(LA.det(U @ VT))
+    R = U @ D @ VT
+    s = np.trace(np.diag(S) @ D) / np.mean(np.sum(src_c**2, 1))
+    return s * src @ R.T + (mu_dst - s * R @ mu_src)
+
+
+def compute_precision_recall(inliers, outliers):
+    tp = np.sum(inliers & ~outliers)
+    precision = tp / max(np.sum(inliers), 1)
+    recall = tp / max(np.sum(~outliers), 1)
+    return float(precision), float(recall)
+
+
+def summarize(errors):
+    errors = np.asarray(errors, dtype=float)
+    errors = errors[np.isfinite(errors)]
+    if errors.size == 0:
+        return {'mean': None, 'median': None, 'max': None}
+    return {'mean': float(np.mean(errors)), 'median': float(np.median(errors)), 'max': float(np.max(errors))}
+
+
+def quiet(verbose):
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def benchmark_E(scene, pair, pixel_threshold, solver, verbose):
+    K = scene['K']
+    _, idx1, idx2, outliers = get_correspondences(scene, *pair)
+    x1_norm = normalize_points(K, scene['pts'][pair[0]][:,idx1])
+    x2_norm = normalize_points(K, scene['pts'][pair[1]][:,idx2])
+
+    stats = {}
+    start = time.perf_counter()
+    with quiet(verbose):
+        E, inliers = cv.estimate_E_robust(K, x1_norm, x2_norm, 15000, 20000, 4, 0.99, pixel_threshold, essential_matrix=True, homography=True, verbose=verbose, batch_size=1000, sprt=True, stats=stats, solver=solver, local_optimization=True)
+        elapsed = time.perf_counter() - start
+
+        P1 = cv.get_canonical_camera()
+        P2_arr = cv.extract_P_from_E(E)
+        X_arr = cv.compute_triangulated_X_from_extracted_P2_solutions(P1, P2_arr, x1_norm[:,inliers], x2_norm[:,inliers])
+        P2, _ = cv.extract_valid_camera_and_points(P1, P2_arr, X_arr)
+
+    R_gt = scene['rots'][pair[1]] @ scene['rots'][pair[0]].T
+    T_gt = scene['trans'][pair[1]] - R_gt @ scene['trans'][pair[0]]
+    precision, recall = compute_precision_recall(inliers, outliers)
+    n_its = stats.get('n_iterations', 0)
+
+    return {'n_points': int(x1_norm.shape[1]), 'time_s': elapsed, 'n_iterations': int(n_its), 'hypotheses_per_s': n_its / elapsed,
+            'rotation_error_deg': float(compute_rotation_error(P2[:,:-1], R_gt)), 'translation_error_deg': float(compute_angle_error(P2[:,-1], T_gt)),
+            'inlier_precision': precision, 'inlier_recall': recall}
+
+
+def benchmark_T(scene, cam, pixel_threshold, verbose):
+    K = scene['K']
+    ids = scene['pt_ids'][cam]
+    obs = ids >= 0
+    X = scene['X'][:,ids[obs]]
+    x_norm = normalize_points(K, scene['pts'][cam][:,obs])
+    outliers = scene['outliers'][cam][obs]
+    R_gt = scene['rots'][cam]
+    T_gt = scene['trans'][cam]
+
+    stats = {}
+    start = time.perf_counter()
+    with quiet(verbose):
+        T, inliers = cv.estimate_T_robust(K, R_gt, X, x_norm, 10000, 20000, 3, 0.99, pixel_threshold, verbose=verbose, batch_size=1000, sprt=True, stats=stats, local_optimization=True)
+    elapsed = time.perf_counter() - start
+
+    precision, recall = compute_precision_recall(inliers, outliers)
+    n_its = stats.get('n_iterations', 0)
+
+    return {'n_points': int(x_norm.shape[1]), 'time_s': elapsed, 'n_iterations': int(n_its), 'hypotheses_per_s': n_its / elapsed,
+            'translation_error': float(LA.norm(T - T_gt) / LA.norm(T_gt)), 'inlier_precision': precision, 'inlier_recall': recall}
+
+
+def benchmark_triangulation(scene, pair):
+    K = scene['K']
+    ids, idx1, idx2, outliers = get_correspondences(scene, *pair)
+    ids = ids[~outliers]
+    x1_norm = normalize_points(K, scene['pts'][pair[0]][:,idx1[~outliers]])
+    x2_norm = normalize_points(K, scene['pts'][pair[1]][:,idx2[~outliers]])
+    P1 = np.column_stack((scene['rots'][pair[0]], scene['trans'][pair[0]]))
+    P2 = np.column_stack((scene['rots'][pair[1]], scene['trans'][pair[1]]))
+
+    start = time.perf_counter()
+    X = cv.triangulate_3D_point_DLT(P1, P2, x1_norm, x2_norm)
+    elapsed = time.perf_counter() - start
+
+    errors = LA.norm(cv.dehomogenize(X)[:-1] - scene['X'][:,ids], axis=0)
+    return {'n_points': int(ids.size), 'time_s': elapsed, 'points_per_s': ids.size / elapsed, 'error_3D': summarize(errors)}
+
+
+def perturb_rotations(rots, sigma_deg, rng):
+    noise = Rotation.from_rotvec(rng.normal(0, np.radians(sigma_deg), (len(rots), 3))).as_matrix()
+    return np.array([noise[i] @ rots[i] for i in range(len(rots))])
+
+
+def benchmark_refinement(scene, rot_noise_deg, trans_noise, verbose, seed):
+    rng = np.random.default_rng(seed)
+    K = scene['K']
+    n_cams = len(scene['rots'])
+    X_init = cv.homogenize(scene['X'], multi=True)
+
+    X_idx_TR = []
+    x_norm_TR = []
+    inliers_TR = []
+    for i in range(n_cams):
+        ids = scene['pt_ids'][i]
+        obs = ids >= 0
+        X_idx_TR.append(ids[obs])
+        x_norm_TR.append(normalize_points(K, scene['pts'][i][:,obs]))
+        inliers_TR.append(~scene['outliers'][i][obs])
+
+    abs_rots = perturb_rotations(scene['rots'], rot_noise_deg, rng)
+    trans = scene['trans'] + rng.normal(0, trans_noise, scene['trans'].shape)
+    valid_cameras = np.ones(n_cams, dtype=bool)
+
+    start = time.perf_counter()
+    with quiet(verbose):
+        abs_rots_opt, trans_opt = pl.refine_rotations_and_translations(trans, abs_rots, X_init, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR)
+    elapsed = time.perf_counter() - start
+
+    rot_errors = [compute_rotation_error(abs_rots_opt[i], scene['rots'][i]) for i in range(n_cams)]
+    trans_errors = LA.norm(np.array(trans_opt) - scene['trans'], axis=1)
+    return {'n_observations': int(sum(x.shape[1] for x in x_norm_TR)), 'time_s': elapsed,
+            'rotation_error_deg': summarize(rot_errors), 'translation_error': summarize(trans_errors)}
+
+
+def evaluate_rotations(abs_rots, scene, ref):
+    # Estimated rotations are relative to the reference camera
+    rots_gt = [R @ scene['rots'][ref].T for R in scene['rots']]
+    return summarize([compute_rotation_error(abs_rots[i], rots_gt[i]) for i in range(len(rots_gt))])
+
+
+def evaluate_cameras(rots, trans, valid_cameras, scene):
+    valid_idx = np.flatnonzero(valid_cameras)
+    if valid_idx.size < 3:
+        return {'n_valid_cameras': int(valid_idx.size)}
+    C = compute_camera_centers(np.asarray(rots)[valid_idx], np.asarray(trans)[valid_idx])
+    C_gt = compute_camera_centers(scene['rots'][valid_idx], scene['trans'][valid_idx])
+    C_aligned = align_similarity(C, C_gt)
+    scale = np.mean(LA.norm(C_gt - C_gt.mean(0), axis=1))
+    return {'n_valid_cameras': int(valid_idx.size), 'center_error': summarize(LA.norm(C_aligned - C_gt, axis=1) / scale)}
+
+
+def benchmark_stages(scene, pixel_threshold, run_ba, verbose):
+    K = scene['K']
+    features = SyntheticFeatures(scene)
+    n_cams = len(features)
+    init_pair = [0, n_cams-1]
+    results = {}
+
+    def run(stage, compute):
+        start = time.perf_counter()
+        with quiet(verbose):
+            outputs = compute()
+        results[stage] = {'time_s': time.perf_counter() - start}
+        return outputs
+
+    abs_rots, x1_norm_RA, x2_norm_RA, inliers_RA, matches_RA = run('rotation_averaging', lambda: pl.compute_rotation_averaging(features, init_pair, K, pixel_threshold))
+    results['rotation_averaging']['rotation_error_deg'] = evaluate_rotations(abs_rots, scene, init_pair[0])
+
+    x1_init, x2_init, des1_init, des2_init, X_init, X_init_idx, kp_init_idx = run('initial_3D_points', lambda: pl.compute_initial_3D_points(features, init_pair, K, 3*pixel_threshold))
+    results['initial_3D_points']['n_points'] = int(X_init.shape[1])
+
+    trans, valid_cameras, x_norm_TR, X_idx_TR, inliers_TR, _ = run('translation_registration', lambda: pl.compute_translation_registration(K, features, init_pair, 3*pixel_threshold, abs_rots, x1_init, x2_init, des1_init, X_init, X_init_idx, kp_init_idx))
+    results['translation_registration'].update(evaluate_cameras(abs_rots, trans, valid_cameras, scene))
+
+    abs_rots_opt, trans_opt = run('refinement', lambda: pl.refine_rotations_and_translations(trans, abs_rots, X_init, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR))
+    results['refinement'].update(evaluate_cameras(abs_rots_opt, trans_opt, valid_cameras, scene))
+
+    if run_ba:
+        cameras_ba, _ = run('bundle_adjustment', lambda: pl.compute_bundle_adjustment(trans, abs_rots, X_init, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR, init_pair))
+        results['bundle_adjustment'].update(evaluate_cameras(cameras_ba[:,:,:-1], cameras_ba[:,:,-1], valid_cameras, scene))
+
+    cameras_opt = pl.create_cameras(abs_rots_opt, trans_opt)
+    X_final, _ = run('final_3D_reconstruction', lambda: pl.triangulate_final_3D_reconstruction(features, K, pixel_threshold, cameras_opt, valid_cameras, inliers_RA, x1_norm_RA, x2_norm_RA, matches_RA=matches_RA, tracks=True))
+    results['final_3D_reconstruction']['n_points'] = int(sum(X.shape[1] for X in X_final))
+    return results
+
+
+def run_benchmark(n_cams, n_pts, args):
+    seed = args.seed
+    np.random.seed(seed)
+    scene = generate_scene(n_cams, n_pts, noise_px=args.noise_px, outlier_ratio=args.outlier_ratio, planar=args.planar, n_distractors=int(args.distractor_ratio*n_pts), seed=seed)
+    pair = (0, 1)
+    pixel_threshold = args.pixel_threshold
+
+    kernels = {}
+    kernels['estimate_E_robust'] = benchmark_E(scene, pair, pixel_threshold, args.solver, args.verbose)
+    kernels['estimate_T_robust'] = benchmark_T(scene, 1, 3*pixel_threshold, args.verbose)
+    kernels['triangulate_3D_point_DLT'] = benchmark_triangulation(scene, pair)
+    kernels['refine_rotations_and_translations'] = benchmark_refinement(scene, args.rot_noise_deg, args.trans_noise, args.verbose, seed)
+
+    result = {'n_cams': n_cams, 'n_pts': n_pts, 'kernels': kernels}
+    if not args.skip_stages:
+        result['stages'] = benchmark_stages(scene, pixel_threshold, args.ba, args.verbose)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n_cams', type=int, nargs='+', default=[5])
+    parser.add_argument('-n_pts', type=int, nargs='+', default=[1000, 4000])
+    parser.add_argument('-noise_px', type=float, default=0.5)
+    parser.add_argument('-outlier_ratio', type=float, default=0.2)
+    parser.add_argument('-distractor_ratio', type=float, default=0.2)
+    parser.add_argument('-planar', action='store_true')
+    parser.add_argument('-pixel_threshold', type=float, default=1.0)
+    parser.add_argument('-solver', type=str, default='5point', choices=['8point', '5point'])
+    parser.add_argument('-rot_noise_deg', type=float, default=1.0)
+    parser.add_argument('-trans_noise', type=float, default=0.05)
+    parser.add_argument('-ba', action='store_true')
+    parser.add_argument('-skip_stages', action='store_true')
+    parser.add_argument('-seed', type=int, default=0)
+    parser.add_argument('-verbose', action='store_true')
+    parser.add_argument('-output', type=str, default=None)
+    args = parser.parse_args()
+
+    results = []
+    for n_cams in args.n_cams:
+        for n_pts in args.n_pts:
+            print('Benchmarking', n_cams, 'cameras and', n_pts, 'points', file=sys.stderr)
+            results.append(run_benchmark(n_cams, n_pts, args))
+
+    report = {'config': vars(args), 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
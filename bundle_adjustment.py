@@ -0,0 +1,138 @@
+from numpy import linalg as LA
+import numpy as np
+from scipy import sparse
+from scipy.spatial.transform import Rotation
+import time
+
+
+def compute_skew_symmetric_matrices(v):
+    zero = np.zeros(v.shape[0])
+    S = np.stack([np.stack([zero, -v[:,2], v[:,1]], 1),
+                  np.stack([v[:,2], zero, -v[:,0]], 1),
+                  np.stack([-v[:,1], v[:,0], zero], 1)], 1)
+    return S
+
+
+def compute_residuals(rots, trans, X, cam_idx, pt_idx, x_obs):
+    RX = np.einsum('mij,jm->mi', rots[cam_idx], X[:,pt_idx])
+    Y = RX + trans[cam_idx]
+    x_proj = Y[:,:2] / Y[:,2:]
+    residuals = x_proj - x_obs.T
+    return residuals, RX, Y, x_proj
+
+
+def compute_jacobians(rots, RX, Y, x_proj, cam_idx):
+    n_obs = Y.shape[0]
+    z_inv = 1 / Y[:,2]
+
+    dx_dY = np.zeros((n_obs, 2, 3))
+    dx_dY[:,0,0] = z_inv
+    dx_dY[:,1,1] = z_inv
+    dx_dY[:,:,2] = -x_proj * z_inv[:,None]
+
+    # Camera update R <- exp([w]_x) R, t <- t + dt gives dY/dw = -[RX]_x and dY/dt = I
+    J_cam = np.concatenate((dx_dY @ -compute_skew_symmetric_matrices(RX), dx_dY), 2) # (m, 2, 6)
+    J_pt = dx_dY @ rots[cam_idx] # (m, 2, 3)
+    return J_cam, J_pt
+
+
+def accumulate_blocks(idx, blocks, n):
+    acc = np.zeros((n,) + blocks.shape[1:])
+    np.add.at(acc, idx, blocks)
+    return acc
+
+
+def solve_reduced_camera_system(U, V, W, g_cam, g_pt, cam_idx, pt_idx, fixed_cams, lam):
+    n_cams = U.shape[0]
+    n_pts = V.shape[0]
+
+    U_damped = U + lam * np.eye(6) * (np.diagonal(U, axis1=1, axis2=2)[:,:,None] + 1e-12)
+    V_damped = V + lam * np.eye(3) * (np.diagonal(V, axis1=1, axis2=2)[:,:,None] + 1e-12)
+    U_damped[fixed_cams] = np.eye(6)
+    V_inv = LA.inv(V_damped)
+
+    # Schur complement S = U - W V^-1 W^T, assembled from per-observation blocks
+    Y = W @ V_inv[pt_idx] # (m, 6, 3)
+    rows_Y = (6*cam_idx[:,None,None] + np.arange(6)[None,:,None]).repeat(3, 2)
+    cols_Y = (3*pt_idx[:,None,None] + np.arange(3)[None,None,:]).repeat(6, 1)
+    Y_mat = sparse.csr_matrix((Y.ravel(), (rows_Y.ravel(), cols_Y.ravel())), shape=(6*n_cams, 3*n_pts))
+    W_mat = sparse.csr_matrix((W.ravel(), (rows_Y.ravel(), cols_Y.ravel())), shape=(6*n_cams, 3*n_pts))
+
+    S = sparse.block_diag(list(U_damped), format='csr') - Y_mat @ W_mat.T
+    rhs = -g_cam.ravel() + Y_mat @ g_pt.ravel()
+    delta_cam = LA.solve(S.toarray(), rhs).reshape(n_cams, 6)
+    delta_cam[fixed_cams] = 0
+
+    WT_delta = accumulate_blocks(pt_idx, np.einsum('mij,mi->mj', W, delta_cam[cam_idx]), n_pts)
+    delta_pt = np.einsum('pij,pj->pi', V_inv, -g_pt - WT_delta)
+    return delta_cam, delta_pt
+
+
+def update_parameters(rots, trans, X, delta_cam, delta_pt):
+    rots_new = Rotation.from_rotvec(delta_cam[:,:3]).as_matrix() @ rots
+    trans_new = trans + delta_cam[:,3:]
+    X_new = X + delta_pt.T
+    return rots_new, trans_new, X_new
+
+
+def bundle_adjust(rots, trans, X, cam_idx, pt_idx, x_obs, fixed_cams=None, max_its=50, lambda_init=1e-3, tol=1e-10, verbose=False):
+    rots = np.array(rots, dtype=float)
+    trans = np.array(trans, dtype=float)
+    X = np.array(X[:3], dtype=float)
+    n_cams = rots.shape[0]
+    n_pts = X.shape[1]
+
+    if fixed_cams is None:
+        fixed_cams = np.zeros(n_cams, dtype=bool)
+
+    residuals, RX, Y, x_proj = compute_residuals(rots, trans, X, cam_idx, pt_idx, x_obs)
+    cost = 0.5 * np.sum(residuals**2)
+    lam = lambda_init
+
+    if verbose:
+        print('Bundle adjustment:', n_cams, 'cameras,', n_pts, 'points,', cam_idx.shape[0], 'observations')
+        print('Iteration:', 0, 'Cost:', cost)
+
+    for it in range(max_its):
+        t_start = time.time()
+
+        J_cam, J_pt = compute_jacobians(rots, RX, Y, x_proj, cam_idx)
+        J_cam[fixed_cams[cam_idx]] = 0
+
+        U = accumulate_blocks(cam_idx, np.swapaxes(J_cam,1,2) @ J_cam, n_cams)
+        V = accumulate_blocks(pt_idx, np.swapaxes(J_pt,1,2) @ J_pt, n_pts)
+        W = np.swapaxes(J_cam,1,2) @ J_pt
+        g_cam = accumulate_blocks(cam_idx, np.einsum('mij,mi->mj', J_cam, residuals), n_cams)
+        g_pt = accumulate_blocks(pt_idx, np.einsum('mij,mi->mj', J_pt, residuals), n_pts)
+
+        while True:
+            delta_cam, delta_pt = solve_reduced_camera_system(U, V, W, g_cam, g_pt, cam_idx, pt_idx, fixed_cams, lam)
+            rots_new, trans_new, X_new = update_parameters(rots, trans, X, delta_cam, delta_pt)
+            residuals_new, RX_new, Y_new, x_proj_new = compute_residuals(rots_new, trans_new, X_new, cam_idx, pt_idx, x_obs)
+            cost_new = 0.5 * np.sum(residuals_new**2)
+
+            if cost_new < cost:
+                lam = max(lam / 10, 1e-12)
+                break
+
+            lam *= 10
+            if lam > 1e12:
+                break
+
+        if cost_new >= cost:
+            if verbose:
+                print('Iteration:', it+1, 'No cost decrease, stopping')
+            break
+
+        cost_decrease = cost - cost_new
+        rots, trans, X = rots_new, trans_new, X_new
+        residuals, RX, Y, x_proj = residuals_new, RX_new, Y_new, x_proj_new
+        cost = cost_new
+
+        if verbose:
+            print('Iteration:', it+1, 'Cost:', cost, 'Lambda:', lam, 'Time:', np.round(time.time() - t_start, 3))
+
+        if cost_decrease < tol * cost:
+            break
+
+    return rots, trans, X
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import numpy as np
+import os
+
+
+STAGES = ['rotation_averaging', 'initial_3D_points', 'translation_registration', 'refinement', 'bundle_adjustment']
+# Bumped whenever the outputs of a stage change, so checkpoints written by older code are not loaded
+OUTPUT_VERSION = 2
+
+
+def compute_params_hash(params):
+    params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(params.encode()).hexdigest()[:16]
+
+
+def save_stage_outputs(path, outputs):
+    arrays = {}
+    for k, output in enumerate(outputs):
+        if isinstance(output, (list, tuple)):
+            arrays['out{}_len'.format(k)] = np.array(len(output))
+            for j, a in enumerate(output):
+                arrays['out{}_{}'.format(k, j)] = np.asarray(a)
+        else:
+            arrays['out{}'.format(k)] = np.asarray(output)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_stage_outputs(path):
+    outputs = []
+    with np.load(path) as data:
+        k = 0
+        while True:
+            if 'out{}'.format(k) in data:
+                outputs.append(data['out{}'.format(k)])
+            elif 'out{}_len'.format(k) in data:
+                n = int(data['out{}_len'.format(k)])
+                outputs.append([data['out{}_{}'.format(k, j)] for j in range(n)])
+            else:
+                break
+            k += 1
+    return tuple(outputs)
+
+
+class StageCheckpoints:
+
+    def __init__(self, checkpoint_dir, dataset, resume_from=None):
+        if resume_from is not None and resume_from not in STAGES:
+            raise ValueError('Unknown stage {}, expected one of {}'.format(resume_from, STAGES))
+        if resume_from is not None and checkpoint_dir is None:
+            raise ValueError('Resuming from stage {} requires a checkpoint directory'.format(resume_from))
+
+        self.checkpoint_dir = checkpoint_dir
+        self.dataset = dataset
+        self.resume_idx = STAGES.index(resume_from) if resume_from is not None else 0
+        self.upstream_hash = None
+
+    def stage_path(self, stage, params_hash):
+        return os.path.join(self.checkpoint_dir, 'dataset_{}'.format(self.dataset), '{}-{}.npz'.format(stage, params_hash))
+
+    def run(self, stage, params, compute):
+        # Chaining the upstream hash invalidates every stage downstream of a changed one
+        params_hash = compute_params_hash(dict(params, stage=stage, upstream=self.upstream_hash, version=OUTPUT_VERSION))
+        self.upstream_hash = params_hash
+
+        if self.checkpoint_dir is None:
+            return compute()
+
+        path = self.stage_path(stage, params_hash)
+        if STAGES.index(stage) < self.resume_idx:
+            if not os.path.exists(path):
+                raise FileNotFoundError('No checkpoint for stage {} at {}, run the pipeline without resuming first'.format(stage, path))
+            print('\nLoading checkpoint for stage {}: {}'.format(stage, path))
+            return load_stage_outputs(path)
+
+        outputs = compute()
+        save_stage_outputs(path, outputs)
+        return outputs
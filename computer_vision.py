@@ -1,22 +1,12 @@
 import cv2
-import matplotlib as mpl
-import matplotlib.image as mpimg
-from matplotlib.pyplot import cm
-import matplotlib.pyplot as plt
-from mpl_toolkits import mplot3d
+import instrumentation as ins
 from numpy import linalg as LA
 import numpy as np
+import os
 
 
-def load_image(path, multi=False):
-    if multi:
-        img = []    
-        for im in path:
-            img.append(cv2.imread(im)) 
-        img = np.array(img)
-    else:
-        img = cv2.imread(path)  
-    return img 
+# Batched inlier scoring works on chunks of hypotheses times points, scoring temporaries take about 80 bytes per element
+MAX_CHUNK_ELEMENTS = 2**20
 
 
 def dehomogenize(x):
@@ -38,79 +28,138 @@ def get_canonical_camera():
     return P
 
 
-def compute_sift_points(img1, img2, marg, flann=False, verbose=False):
-    img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-    img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+def detect_sift_points(img, sift_params=None):
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    if sift_params is None:
+        sift_params = {}
+    sift = cv2.SIFT_create(**sift_params)
+    kp, des = sift.detectAndCompute(img, None)
+
+    pts = np.array([k.pt for k in kp], dtype=float).reshape(-1, 2).T
+    if des is None:
+        des = np.zeros((0, 128), dtype=np.float32)
+    return pts, des
 
-    sift = cv2.SIFT_create()
-    kp1, des1 = sift.detectAndCompute(img1, None)
-    kp2, des2 = sift.detectAndCompute(img2, None)
 
-    if flann:
-        FLANN_INDEX_KDTREE = 1
-        index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
-        search_params = dict(checks=50) 
+def build_flann_index(des, seed=0):
+    FLANN_INDEX_KDTREE = 1
+    index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
+    search_params = dict(checks=50) 
 
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-        matches = flann.knnMatch(des1, des2, k=2)
+    # The randomized trees are seeded, so every build over the same descriptors returns the same neighbours
+    cv2.setRNGSeed(seed)
+    index = cv2.FlannBasedMatcher(index_params, search_params)
+    index.add([des])
+    index.train()
+    return index
+
+
+def knn_match_sift_descriptors(des1, des2, flann=False, index2=None):
+    if index2 is not None:
+        matches = index2.knnMatch(des1, k=2)
+    elif flann:
+        index2 = build_flann_index(des2)
+        matches = index2.knnMatch(des1, k=2)
     else:
         bf = cv2.BFMatcher()
         matches = bf.knnMatch(des1, des2, k=2)
+    return matches
+
+
+def matches_to_arrays(matches):
+    knn = [(m.queryIdx, m.trainIdx, m.distance, n.distance) for m, n in (k for k in matches if len(k) == 2)]
+    knn = np.array(knn, dtype=float).reshape(-1, 4)
 
-    good_matches = []
-    for m, n in matches:
-        if m.distance < marg*n.distance:
-            good_matches.append([m])
+    query_idx = knn[:,0].astype(int)
+    train_idx = knn[:,1].astype(int)
+    distances = knn[:,2:]
+    return query_idx, train_idx, distances
 
-    x1 = np.stack([kp1[match[0].queryIdx].pt for match in good_matches],1)
-    x2 = np.stack([kp2[match[0].trainIdx].pt for match in good_matches],1)
-    x1 = homogenize(x1, multi=True)
-    x2 = homogenize(x2, multi=True)
 
-    des1 = np.stack([des1[match[0].queryIdx] for match in good_matches],0)
-    des2 = np.stack([des2[match[0].trainIdx] for match in good_matches],0)
+def filter_matches_ratio(query_idx, train_idx, distances, marg):
+    good = distances[:,0] < marg*distances[:,1]
+    ratio = distances[good,0] / distances[good,1]
+    return query_idx[good], train_idx[good], ratio
 
+
+def filter_matches_mutual(query_idx, train_idx, ratio, des_query, des_train, index_query=None):
+    # The nearest query descriptor of each matched train descriptor must be the original query
+    if index_query is None:
+        index_query = build_flann_index(des_query)
+
+    back_matches = index_query.knnMatch(des_train[train_idx], k=1)
+    back_idx = np.array([k[0].trainIdx if len(k) > 0 else -1 for k in back_matches], dtype=int)
+    mutual = back_idx == query_idx
+    return query_idx[mutual], train_idx[mutual], ratio[mutual]
+
+
+@ins.timed
+def match_sift_indices(des1, des2, marg, flann=False, index1=None, index2=None, mutual=False, verbose=False):
+    matches = knn_match_sift_descriptors(des1, des2, flann=flann, index2=index2)
+    query_idx, train_idx, distances = matches_to_arrays(matches)
+    idx1, idx2, ratio = filter_matches_ratio(query_idx, train_idx, distances, marg)
+
+    if mutual:
+        idx1, idx2, ratio = filter_matches_mutual(idx1, idx2, ratio, des1, des2, index_query=index1)
+
+    ins.record('match_sift_indices', n_matches=np.size(query_idx,0), n_good_matches=np.size(idx1,0))
     if verbose:
-        print('Number of matches:', np.size(matches,0))
-        print('Number of good matches:', np.size(x1,1))
+        print('Number of matches:', np.size(query_idx,0))
+        print('Number of good matches:', np.size(idx1,0))
 
-    return x1, x2, des1, des2
+    return idx1, idx2, ratio
 
 
-def compute_sift_points_TR(x1, des1, img2, marg, flann=False, verbose=False):
-    img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+def match_sift_points(pts1, des1, pts2, des2, marg, flann=False, verbose=False, index1=None, index2=None, mutual=False, quality=False):
+    idx1, idx2, ratio = match_sift_indices(des1, des2, marg, flann=flann, index1=index1, index2=index2, mutual=mutual, verbose=verbose)
 
-    sift = cv2.SIFT_create()
-    kp2, des2 = sift.detectAndCompute(img2, None)
+    x1 = homogenize(pts1[:,idx1], multi=True)
+    x2 = homogenize(pts2[:,idx2], multi=True)
+    des1 = des1[idx1]
+    des2 = des2[idx2]
 
-    if flann:
-        FLANN_INDEX_KDTREE = 1
-        index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
-        search_params = dict(checks=50) 
+    if quality:
+        return x1, x2, des1, des2, ratio
+    return x1, x2, des1, des2
 
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-        matches = flann.knnMatch(des1, des2, k=2)
-    else:
-        bf = cv2.BFMatcher()
-        matches = bf.knnMatch(des1, des2, k=2)
 
-    good_matches = []
-    for m, n in matches:
-        if m.distance < marg*n.distance:
-            good_matches.append([m])
+@ins.timed
+def match_sift_points_TR(x1, des1, pts2, des2, marg, flann=False, verbose=False, index2=None, mutual=False, quality=False):
+    # The descriptors of the 3D points are the queries, so the ratio test compares keypoints of the new image
+    matches = knn_match_sift_descriptors(des1, des2, flann=flann, index2=index2)
+
+    query_idx, train_idx, distances = matches_to_arrays(matches)
+    good_query_idx, good_train_idx, ratio = filter_matches_ratio(query_idx, train_idx, distances, marg)
+    if mutual:
+        good_query_idx, good_train_idx, ratio = filter_matches_mutual(good_query_idx, good_train_idx, ratio, des1, des2)
+    x_idx, img_idx = good_query_idx, good_train_idx
 
-    x_idx = np.array([match[0].queryIdx for match in good_matches])
-    x1 = np.stack([x1[:,match[0].queryIdx] for match in good_matches],1)
-    x2 = np.stack([kp2[match[0].trainIdx].pt for match in good_matches],1)
-    x2 = homogenize(x2, multi=True)
+    x1 = x1[:,x_idx]
+    x2 = homogenize(pts2[:,img_idx], multi=True)
 
+    ins.record('match_sift_points_TR', n_matches=np.size(query_idx,0), n_good_matches=np.size(x1,1))
     if verbose:
-        print('Number of matches:', np.size(matches,0))
+        print('Number of matches:', np.size(query_idx,0))
         print('Number of good matches:', np.size(x1,1))
 
+    if quality:
+        return x1, x2, x_idx, ratio
     return x1, x2, x_idx
 
 
+def compute_sift_points(img1, img2, marg, flann=False, verbose=False):
+    pts1, des1 = detect_sift_points(img1)
+    pts2, des2 = detect_sift_points(img2)
+    return match_sift_points(pts1, des1, pts2, des2, marg, flann=flann, verbose=verbose)
+
+
+def compute_sift_points_TR(x1, des1, img2, marg, flann=False, verbose=False):
+    pts2, des2 = detect_sift_points(img2)
+    return match_sift_points_TR(x1, des1, pts2, des2, marg, flann=flann, verbose=verbose)
+
+
 def enforce_essential(E):
     U, _, VT = LA.svd(E, full_matrices=False)
     if LA.det(U @ VT) < 0:
@@ -131,7 +180,7 @@ def estimate_E_DLT(img1_pts_norm, img2_pts_norm, enforce=False):
         M.append([m])
 
     M = np.concatenate(M, 0)
-    _, _, VT = LA.svd(M, full_matrices=False)
+    _, _, VT = LA.svd(M)
     E = VT[-1,:].reshape(3,3)
     if enforce:
         E = enforce_essential(E)
@@ -140,12 +189,106 @@ def estimate_E_DLT(img1_pts_norm, img2_pts_norm, enforce=False):
     return E
 
 
+def enforce_essential_batch(E_arr):
+    U, _, VT = LA.svd(E_arr, full_matrices=False)
+    flip = LA.det(U @ VT) < 0
+    VT[flip] = -VT[flip]
+    E_arr = U @ (np.array([1,1,0])[:,None] * VT)
+    return E_arr
+
+
+def estimate_E_DLT_batch(img1_pts_norm, img2_pts_norm, enforce=False):
+    n_batch, _, n = img1_pts_norm.shape
+    M = img2_pts_norm[:,:,None,:] * img1_pts_norm[:,None,:,:]
+    M = M.transpose(0,3,1,2).reshape(n_batch, n, 9)
+
+    _, _, VT = LA.svd(M)
+    E_arr = VT[:,-1,:].reshape(n_batch,3,3)
+    if enforce:
+        E_arr = enforce_essential_batch(E_arr)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        E_arr = E_arr/E_arr[:,-1,-1][:,None,None]
+    return E_arr
+
+
+# Monomials in x, y, z of the 5-point constraints, the 10 cubics first and the 10 basis monomials of the quotient ring last
+FIVE_POINT_MONOMIALS = [(3,0,0), (2,1,0), (2,0,1), (1,2,0), (1,1,1), (1,0,2), (0,3,0), (0,2,1), (0,1,2), (0,0,3),
+                        (2,0,0), (1,1,0), (1,0,1), (0,2,0), (0,1,1), (0,0,2), (1,0,0), (0,1,0), (0,0,1), (0,0,0)]
+
+
+def compute_monomial_products(monomials1, monomials2, monomials):
+    products = np.zeros((len(monomials1), len(monomials2), len(monomials)))
+    for i, m1 in enumerate(monomials1):
+        for j, m2 in enumerate(monomials2):
+            products[i,j,monomials.index(tuple(np.add(m1, m2)))] = 1
+    return products
+
+
+FIVE_POINT_LINEAR_PRODUCTS = compute_monomial_products(FIVE_POINT_MONOMIALS[16:], FIVE_POINT_MONOMIALS[16:], FIVE_POINT_MONOMIALS)
+FIVE_POINT_QUADRATIC_PRODUCTS = compute_monomial_products(FIVE_POINT_MONOMIALS[10:], FIVE_POINT_MONOMIALS[16:], FIVE_POINT_MONOMIALS)
+
+
+def estimate_E_5point_batch(img1_pts_norm, img2_pts_norm):
+    n_batch = img1_pts_norm.shape[0]
+    M = img2_pts_norm[:,:,None,:] * img1_pts_norm[:,None,:,:]
+    M = M.transpose(0,3,1,2).reshape(n_batch, 5, 9)
+
+    # E = x*X + y*Y + z*Z + W over the nullspace of the epipolar constraints
+    _, _, VT = LA.svd(M)
+    nullspace = VT[:,5:,:]
+    E_lin = nullspace.transpose(0,2,1).reshape(n_batch, 3, 3, 4)
+
+    # Polynomial coefficients of E E^T, 2 E E^T E - tr(E E^T) E and det(E)
+    EEt = np.einsum('bikp,bjkq,pqr->bijr', E_lin, E_lin, FIVE_POINT_LINEAR_PRODUCTS)[...,10:]
+    EEtE = np.einsum('bikp,bkjq,pqr->bijr', EEt, E_lin, FIVE_POINT_QUADRATIC_PRODUCTS)
+    trace = EEt[:,0,0] + EEt[:,1,1] + EEt[:,2,2]
+    trace_E = np.einsum('bp,bijq,pqr->bijr', trace, E_lin, FIVE_POINT_QUADRATIC_PRODUCTS)
+    constraints = (2*EEtE - trace_E).reshape(n_batch, 9, 20)
+
+    minor = lambda a, b, c, d: np.einsum('bp,bq,pqr->br', E_lin[:,a,b], E_lin[:,c,d], FIVE_POINT_LINEAR_PRODUCTS)[:,10:]
+    cofactors = np.stack([minor(1,1,2,2) - minor(1,2,2,1), minor(1,2,2,0) - minor(1,0,2,2), minor(1,0,2,1) - minor(1,1,2,0)], 1)
+    det = np.einsum('bjp,bjq,pqr->br', cofactors, E_lin[:,0], FIVE_POINT_QUADRATIC_PRODUCTS)
+    constraints = np.concatenate([det[:,None], constraints], 1)
+
+    # Gauss-Jordan elimination expresses each cubic in the basis [x^2, xy, xz, y^2, yz, z^2, x, y, z, 1]
+    try:
+        G = LA.solve(constraints[:,:,:10], constraints[:,:,10:])
+    except LA.LinAlgError:
+        G = LA.pinv(constraints[:,:,:10]) @ constraints[:,:,10:]
+
+    # Action matrix of multiplication by x, its eigenvectors are the basis evaluated at the solutions (Stewenius)
+    action = np.zeros((n_batch, 10, 10))
+    action[:,:6] = -G[:,:6]
+    action[:,6,0] = 1
+    action[:,7,1] = 1
+    action[:,8,2] = 1
+    action[:,9,6] = 1
+
+    eigvals, eigvecs = LA.eig(action)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sols = (eigvecs[:,6:9,:] / eigvecs[:,9:,:]).real
+    real = np.abs(eigvals.imag) < 1e-6 * np.maximum(1, np.abs(eigvals))
+
+    E_arr = np.einsum('bks,bkn->bsn', np.concatenate([sols, np.ones((n_batch,1,10))], 1), nullspace)
+    E_arr = E_arr / LA.norm(E_arr, axis=2, keepdims=True)
+    E_valid = real & np.all(np.isfinite(E_arr), axis=2)
+    return E_arr.reshape(n_batch, 10, 3, 3), E_valid # up to 10 solutions per sample
+
+
 def compute_E_validity(E):
     rank = LA.matrix_rank(E)
     valid = True if rank == 2 else False
     return valid
 
 
+def compute_E_validity_batch(E_arr):
+    finite = np.all(np.isfinite(E_arr), axis=(1,2))
+    rank = LA.matrix_rank(np.where(finite[:,None,None], E_arr, 0))
+    valid = finite & (rank == 2)
+    return valid
+
+
 def compute_epipolar_lines(F, x1, x2):
     l2 = F @ x1
     l1 = F.T @ x2
@@ -188,8 +331,123 @@ def compute_E_inliers(E, x1_norm, x2_norm, err_threshold):
     return epsilon_E, inliers
 
 
+def compute_squared_epipolar_errors_batch(E_arr, x1, x2):
+    n_batch = E_arr.shape[0]
+    l2 = (E_arr.reshape(n_batch*3, 3) @ x1).reshape(n_batch, 3, -1)
+    l1 = (np.swapaxes(E_arr,1,2).reshape(n_batch*3, 3) @ x2).reshape(n_batch, 3, -1)
+    residual2 = np.einsum('bin,in->bn', l2, x2)**2
+    distance1_arr2 = residual2 / (l1[:,0]**2 + l1[:,1]**2)
+    distance2_arr2 = residual2 / (l2[:,0]**2 + l2[:,1]**2)
+    return distance1_arr2, distance2_arr2
+
+
+def compute_E_inlier_mask_batch(E_arr, x1_norm, x2_norm, err_threshold):
+    distance1_arr2, distance2_arr2 = compute_squared_epipolar_errors_batch(E_arr, x1_norm, x2_norm)
+    return ((distance1_arr2 + distance2_arr2) / 2) < err_threshold**2
+
+
+def compute_E_inliers_batch(E_arr, x1_norm, x2_norm, err_threshold, max_chunk_elements=MAX_CHUNK_ELEMENTS):
+    n_points = x1_norm.shape[1]
+    chunk_size = max(1, max_chunk_elements // max(n_points, 1))
+    n_inliers = np.zeros(E_arr.shape[0], dtype=int)
+
+    for start in range(0, E_arr.shape[0], chunk_size):
+        inliers = compute_E_inlier_mask_batch(E_arr[start:start+chunk_size], x1_norm, x2_norm, err_threshold)
+        n_inliers[start:start+chunk_size] = np.sum(inliers, axis=1)
+
+    epsilon_E_arr = n_inliers / n_points
+    return epsilon_E_arr
+
+
+def compute_normalization_matrix(x):
+    # Hartley normalization, centroid at the origin and mean distance sqrt(2)
+    mean = np.mean(x[:2], axis=1)
+    scale = np.sqrt(2) / np.mean(LA.norm(x[:2] - mean[:,None], axis=0))
+    N = np.array([[scale, 0, -scale*mean[0]],
+                  [0, scale, -scale*mean[1]],
+                  [0, 0, 1]])
+    return N
+
+
+def refine_E_local(E, x1_norm, x2_norm, err_threshold, n_its=4, threshold_scale=3):
+    # Iteratively reweighted DLT on the inliers of a shrinking threshold (LO-RANSAC)
+    best_E = E
+    best_epsilon, best_inliers = compute_E_inliers(E, x1_norm, x2_norm, err_threshold)
+
+    for threshold in np.linspace(threshold_scale*err_threshold, err_threshold, n_its):
+        distance1_arr2, distance2_arr2 = compute_squared_epipolar_errors_batch(E[None], x1_norm, x2_norm)
+        distance_arr2 = ((distance1_arr2 + distance2_arr2) / 2)[0]
+        inliers = distance_arr2 < threshold**2
+        if np.sum(inliers) < 8:
+            break
+
+        # Rows are weighted to Sampson errors of the previous fit, with Cauchy weights on top
+        x1 = x1_norm[:,inliers]
+        x2 = x2_norm[:,inliers]
+        l2 = E @ x1
+        l1 = E.T @ x2
+        sampson_denom = l1[0]**2 + l1[1]**2 + l2[0]**2 + l2[1]**2
+        weights = np.sqrt(1 / (1 + distance_arr2[inliers] / err_threshold**2) / sampson_denom)
+
+        N1 = compute_normalization_matrix(x1)
+        N2 = compute_normalization_matrix(x2)
+        F = estimate_E_DLT_batch((N1 @ x1)[None], (weights * (N2 @ x2))[None])[0]
+        E = enforce_essential(N2.T @ F @ N1)
+        if not np.all(np.isfinite(E)):
+            break
+
+        epsilon, inliers = compute_E_inliers(E, x1_norm, x2_norm, err_threshold)
+        if epsilon > best_epsilon:
+            best_E, best_epsilon, best_inliers = E, epsilon, inliers
+
+    return best_E, best_epsilon, best_inliers
+
+
+def draw_ransac_samples(n_points, n_samples, n_batch):
+    samples = np.random.randint(0, n_points, (n_batch, n_samples))
+    while True:
+        samples_sorted = np.sort(samples, axis=1)
+        duplicates = np.any(samples_sorted[:,1:] == samples_sorted[:,:-1], axis=1)
+        n_duplicates = np.sum(duplicates)
+        if n_duplicates == 0:
+            return samples
+        samples[duplicates] = np.random.randint(0, n_points, (n_duplicates, n_samples))
+
+
+def compute_prosac_schedule(n_points, n_samples, T_N=200000):
+    # T'_n, the iteration at which PROSAC grows its sampling set to the n best points, for n = n_samples..n_points
+    log_T_m = np.log(T_N) + np.sum(np.log(np.arange(1, n_samples+1) / np.arange(n_points-n_samples+1, n_points+1)))
+    n = np.arange(n_samples, n_points)
+    log_T = log_T_m + np.concatenate(([0], np.cumsum(np.log((n+1) / (n+1-n_samples)))))
+    schedule = 1 + np.concatenate(([0], np.cumsum(np.ceil(np.diff(np.exp(log_T))))))
+    return schedule
+
+
+def draw_prosac_samples(order, n_samples, t_start, n_batch, schedule):
+    n_points = order.shape[0]
+    t = np.arange(t_start+1, t_start+n_batch+1)
+    n = np.minimum(n_samples + np.searchsorted(schedule, t), n_points)
+
+    # The n-th best point, plus n_samples-1 distinct points among the n-1 before it (Floyd's algorithm)
+    samples = np.empty((n_batch, n_samples), dtype=int)
+    samples[:,-1] = n-1
+    n_pool = n-1
+    for c in range(n_samples-1):
+        j = n_pool - (n_samples-1) + c
+        r = np.floor(np.random.rand(n_batch) * (j+1)).astype(int)
+        duplicate = np.any(samples[:,:c] == r[:,None], axis=1)
+        samples[:,c] = np.where(duplicate, j, r)
+
+    # Once the sampling set covers all points, PROSAC falls back to uniform sampling
+    uniform = n == n_points
+    if np.any(uniform):
+        samples[uniform] = draw_ransac_samples(n_points, n_samples, np.sum(uniform))
+    return order[samples]
+
+
 def compute_ransac_iterations(alpha, epsilon, s, min_its, max_its, scale):
-    T = scale * np.ceil(np.log(1-alpha) / np.log(1-epsilon**s))
+    with np.errstate(divide='ignore'):
+        T = scale * np.ceil(np.log(1-alpha) / np.log(1-epsilon**s))
     if np.isinf(T) or T > max_its:
         T = max_its
     elif T < min_its:
@@ -197,6 +455,71 @@ def compute_ransac_iterations(alpha, epsilon, s, min_its, max_its, scale):
     return T
 
 
+def compute_prosac_iterations(alpha, inliers, order, s, min_its, max_its, scale, beta=0.05, C=2.33):
+    # Maximality over the quality-ordered prefixes whose inlier count is unlikely under a wrong model (Chum & Matas)
+    n = np.arange(1, order.shape[0]+1)
+    n_inliers = np.cumsum(inliers[order])
+    n_random = np.maximum(n - s, 0)
+    non_random = (n >= s) & (n_inliers >= s + n_random*beta + C*np.sqrt(n_random*beta*(1-beta)))
+
+    epsilon = np.max(n_inliers[non_random] / n[non_random]) if np.any(non_random) else 0
+    return compute_ransac_iterations(alpha, epsilon, s, min_its, max_its, scale)
+
+
+def compute_sprt_threshold(epsilon, delta, model_cost=200, n_models=1):
+    # Wald's decision threshold A, with the cost of a model in units of point evaluations (Chum & Matas)
+    C = (1-delta)*np.log((1-delta)/(1-epsilon)) + delta*np.log(delta/epsilon)
+    A0 = model_cost*C/n_models + 1
+    A = A0
+    for _ in range(10):
+        A = A0 + np.log(A)
+    return A
+
+
+def compute_inliers_sprt(inlier_fn, n_hyps, n_points, best_epsilon, delta, block_size=32, model_cost=200, max_chunk_elements=MAX_CHUNK_ELEMENTS):
+    # inlier_fn(hyp_idx, pt_idx) returns the inlier mask of a subset of hypotheses on a subset of points
+    order = np.random.permutation(n_points)
+    n_inliers = np.zeros(n_hyps, dtype=int)
+    n_evaluated = np.zeros(n_hyps, dtype=int)
+    active = np.arange(n_hyps)
+    best_n_inliers = best_epsilon * n_points
+
+    sprt = 0 < delta < best_epsilon < 1
+    if sprt:
+        log_A = np.log(compute_sprt_threshold(best_epsilon, delta, model_cost=model_cost))
+        log_inlier = np.log(delta/best_epsilon)
+        log_outlier = np.log((1-delta)/(1-best_epsilon))
+
+    # Blocks double in size, so decisions are fine-grained early on and cheap later
+    start = 0
+    while start < n_points and active.size > 0:
+        block = order[start:start+block_size]
+        start += block_size
+        block_size *= 2
+
+        chunk_size = max(1, max_chunk_elements // block.size)
+        for chunk_start in range(0, active.size, chunk_size):
+            chunk = active[chunk_start:chunk_start+chunk_size]
+            n_inliers[chunk] += np.sum(inlier_fn(chunk, block), axis=1)
+        n_evaluated[active] += block.size
+
+        # Abandon hypotheses that can no longer beat the best one, or that are unlikely to be good
+        keep = n_inliers[active] + n_points - n_evaluated[active] > best_n_inliers
+        if sprt:
+            log_lambda = n_inliers[active]*log_inlier + (n_evaluated[active] - n_inliers[active])*log_outlier
+            keep &= log_lambda < log_A
+        active = active[keep]
+
+    epsilon_arr = np.zeros(n_hyps)
+    epsilon_arr[active] = n_inliers[active] / n_points
+
+    # Most hypotheses are bad, so their mean inlier ratio estimates delta
+    evaluated = n_evaluated > 0
+    if np.any(evaluated):
+        delta = max(np.mean(n_inliers[evaluated] / n_evaluated[evaluated]), 1e-3)
+    return epsilon_arr, n_evaluated, delta
+
+
 def estimate_H_DLT(img1_pts, img2_pts):
     n = np.size(img1_pts,1)
     M = []
@@ -215,12 +538,41 @@ def estimate_H_DLT(img1_pts, img2_pts):
         M.append(m)
 
     M = np.concatenate(M, 0)
-    _, _, VT = LA.svd(M, full_matrices=False)
+    _, _, VT = LA.svd(M)
     H = np.stack([VT[-1, i:i+3] for i in range(0, 9, 3)], 0)
 
     return H
 
 
+def estimate_H_DLT_batch(img1_pts, img2_pts):
+    n_batch, _, n = img1_pts.shape
+    x1 = np.swapaxes(img1_pts, 1, 2) # (B, n, 3)
+    u = img2_pts[:,0,:,None]
+    v = img2_pts[:,1,:,None]
+    zeros = np.zeros_like(x1)
+
+    M = np.concatenate([np.concatenate([x1, zeros, -u*x1], 2),
+                        np.concatenate([zeros, x1, -v*x1], 2)], 1) # (B, 2n, 9)
+    _, _, VT = LA.svd(M)
+    H_arr = VT[:,-1,:].reshape(n_batch,3,3)
+    return H_arr
+
+
+def compute_H_inliers_batch(H_arr, x1_norm, x2_norm, err_threshold, max_chunk_elements=MAX_CHUNK_ELEMENTS):
+    n_points = x1_norm.shape[1]
+    chunk_size = max(1, max_chunk_elements // max(n_points, 1))
+    n_inliers = np.zeros(H_arr.shape[0], dtype=int)
+
+    for start in range(0, H_arr.shape[0], chunk_size):
+        x2_proj = H_arr[start:start+chunk_size] @ x1_norm
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance_arr2 = np.sum((x2_proj[:,:2] / x2_proj[:,2:] - x2_norm[None,:2])**2, axis=1)
+        n_inliers[start:start+chunk_size] = np.sum(distance_arr2 < err_threshold**2, axis=1)
+
+    epsilon_H_arr = n_inliers / n_points
+    return epsilon_H_arr
+
+
 def compute_point_point_distance(x_proj, x_img):
     distance_arr = LA.norm(x_proj - x_img, axis=0)
     return distance_arr
@@ -287,6 +639,40 @@ def homography_to_RT(H, x1, x2):
     # R1, t1, R2, t2 = homography_to_RT(H, x1, x2)
 
 
+def homography_to_RT_batch(H_arr, x1, x2):
+    # Batched homography_to_RT, with the sign of each H fixed first
+    H_arr = np.where(LA.det(H_arr)[:,None,None] < 0, -H_arr, H_arr)
+    N = x1.shape[1]
+    positives = np.sum(np.einsum('in,bin->bn', x2, H_arr @ x1) > 0, axis=1)
+    H_arr = np.where((positives < N / 2)[:,None,None], -H_arr, H_arr)
+
+    U, S, VT = LA.svd(H_arr)
+    s1 = S[:,0] / S[:,1]
+    s3 = S[:,2] / S[:,1]
+    a1 = np.sqrt(np.maximum(1 - s3**2, 0))
+    b1 = np.sqrt(np.maximum(s1**2 - 1, 0))
+    a, b = unitize(a1, b1)
+    c, d = unitize(1+s1*s3, a1*b1)
+    e, f = unitize(-b/s1, -a/s3)
+    v1, v3 = VT[:,0,:], VT[:,2,:]
+    n1 = b[:,None] * v1 - a[:,None] * v3
+    n2 = b[:,None] * v1 + a[:,None] * v3
+
+    ones = np.ones_like(c)
+    zeros = np.zeros_like(c)
+    R1 = U @ np.stack([np.stack([c, zeros, d], 1), np.stack([zeros, ones, zeros], 1), np.stack([-d, zeros, c], 1)], 1) @ VT
+    R2 = U @ np.stack([np.stack([c, zeros, -d], 1), np.stack([zeros, ones, zeros], 1), np.stack([d, zeros, c], 1)], 1) @ VT
+    t1 = e[:,None] * v1 + f[:,None] * v3
+    t2 = e[:,None] * v1 - f[:,None] * v3
+    t1 = np.where(n1[:,2:] < 0, -t1, t1)
+    t2 = np.where(n2[:,2:] < 0, -t2, t2)
+
+    # Move from Triggs' convention H = R*(I - t*n') to H&Z notation H = R - t*n'
+    t1 = (R1 @ t1[:,:,None])[:,:,0]
+    t2 = (R2 @ t2[:,:,None])[:,:,0]
+    return R1, t1, R2, t2
+
+
 def create_skew_symmetric_matrix(t):
     T = np.array([[0, -t[2], t[1]],
                   [t[2], 0, -t[0]],
@@ -299,11 +685,83 @@ def compute_E_from_R_and_T(R, T):
     return E
 
 
-def verbose_E_robust(t, T_E, T_H, epsilon_E, epsilon_H, inliers, method):
-    print('Iteration:', t, 'T_E:', T_E, 'T_H:', T_H, 'epsilon_E:', np.round(epsilon_E, 2), 'epsilon_H:', np.round(epsilon_H, 2), 'No. inliers:', np.sum(inliers), 'From:', method)
+def compute_E_from_R_and_T_batch(R_arr, T_arr):
+    # Column j of [t]x R is t x R[:,j]
+    E_arr = np.cross(T_arr[:,:,None], R_arr, axisa=1, axisb=1, axisc=1)
+    return E_arr
+
+
+def compute_H_inliers(H, x1_norm, x2_norm, err_threshold):
+    x2_norm_proj = dehomogenize(H @ x1_norm)
+    distance_arr = compute_point_point_distance(x2_norm_proj, x2_norm)
+    inliers = distance_arr < err_threshold
+    n_inliers = np.sum(inliers)
+    epsilon_H = n_inliers / x1_norm.shape[1]
+    return epsilon_H, inliers
+
+
+def estimate_E_from_H(H, x1_norm, x2_norm, err_threshold):
+    R1, T1, R2, T2 = homography_to_RT(H, x1_norm, x2_norm)
+    best_E = None
+    best_inliers = None
+    best_epsilon_E = 0
+
+    for R, T in ((R1, T1), (R2, T2)):
+        E = compute_E_from_R_and_T(R, T)
+        E_valid = compute_E_validity(E)
+
+        if E_valid:
+            epsilon_E, inliers = compute_E_inliers(E, x1_norm, x2_norm, err_threshold)
+            if epsilon_E > best_epsilon_E:
+                best_E = E
+                best_inliers = inliers
+                best_epsilon_E = epsilon_E
+
+    return best_E, best_epsilon_E, best_inliers
+
+
+def estimate_E_from_H_batch(H_arr, x1_norm, x2_norm):
+    R1, T1, R2, T2 = homography_to_RT_batch(H_arr, x1_norm, x2_norm)
+    E_arr = compute_E_from_R_and_T_batch(np.concatenate([R1, R2], 0), np.concatenate([T1, T2], 0))
+    E_valid = compute_E_validity_batch(E_arr)
+    return E_arr, E_valid # the two decompositions of H_arr[i] are E_arr[i] and E_arr[i+n]
+
+
+def verbose_E_robust(t, T_E, T_H, epsilon_E, epsilon_H, n_inliers, method):
+    print('Iteration:', t, 'T_E:', T_E, 'T_H:', T_H, 'epsilon_E:', np.round(epsilon_E, 2), 'epsilon_H:', np.round(epsilon_H, 2), 'No. inliers:', n_inliers, 'From:', method)
 
 
-def estimate_E_robust(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, err_threshold_px, essential_matrix=True, homography=True, verbose=False):
+def verbose_T_robust(t, ransac_its, epsilon, n_inliers):
+    print('Iteration:', t, 'T:', ransac_its, 'epsilon:', np.round(epsilon, 2), 'No. inliers:', n_inliers)
+
+
+def record_ransac(name, t, inliers):
+    n_points = inliers.shape[0] if inliers is not None else 0
+    n_inliers = int(np.sum(inliers)) if inliers is not None else 0
+    ins.record(name, n_iterations=t, n_points=n_points, n_inliers=n_inliers, inlier_ratio=n_inliers / max(n_points, 1))
+    print('Bailout at iteration:', t)
+
+
+@ins.timed
+def estimate_E_robust(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, err_threshold_px, essential_matrix=True, homography=True, verbose=False, batch_size=None, sprt=False, stats=None, sampling='uniform', quality=None, solver='8point', local_optimization=False):
+
+    if sampling not in ['uniform', 'prosac']:
+        raise ValueError('Unknown sampling {}, expected uniform or prosac'.format(sampling))
+    if sampling == 'prosac' and (batch_size is None or quality is None):
+        raise ValueError('PROSAC sampling requires a batch size and match quality scores')
+    if solver not in ['8point', '5point']:
+        raise ValueError('Unknown solver {}, expected 8point or 5point'.format(solver))
+    if solver == '5point' and batch_size is None:
+        raise ValueError('The 5-point solver requires a batch size')
+    if local_optimization and batch_size is None:
+        raise ValueError('Local optimization requires a batch size')
+    if sprt and batch_size is None:
+        raise ValueError('SPRT requires a batch size')
+    if stats is not None and batch_size is None:
+        raise ValueError('Collecting stats requires a batch size')
+
+    if batch_size is not None:
+        return estimate_E_robust_batched(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, err_threshold_px, batch_size, essential_matrix=essential_matrix, homography=homography, verbose=verbose, sprt=sprt, stats=stats, sampling=sampling, quality=quality, solver=solver, local_optimization=local_optimization)
     
     err_threshold = err_threshold_px / K[0,0]
     best_E = None
@@ -315,6 +773,7 @@ def estimate_E_robust(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, e
     best_epsilon_H = 0
     T_E = max_its
     T_H = max_its
+    progress = []
 
     t = 0
     while t < T_E and t < T_H:
@@ -335,93 +794,275 @@ def estimate_E_robust(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, e
                     T_E = compute_ransac_iterations(alpha, best_epsilon_E, n_E_samples, min_its, max_its, scale_its)
 
                     if verbose:
-                        verbose_E_robust(t, T_E, T_H, best_epsilon_E, best_epsilon_H, best_inliers, method='E 8-point alg.')
+                        progress.append((t, T_E, T_H, best_epsilon_E, best_epsilon_H, np.sum(best_inliers), 'E 8-point alg.'))
         
         if homography:
             rand_mask = np.random.choice(n_points, n_H_samples, replace=False)
             H = estimate_H_DLT(x1_norm[:,rand_mask], x2_norm[:,rand_mask])
-            x2_norm_proj = dehomogenize(H @ x1_norm)
-            distance_arr = compute_point_point_distance(x2_norm_proj, x2_norm)
-            inliers = distance_arr < (3*err_threshold)
-            n_inliers = np.sum(inliers)
-            epsilon_H = n_inliers / n_points
+            epsilon_H, _ = compute_H_inliers(H, x1_norm, x2_norm, 3*err_threshold)
 
             if epsilon_H > best_epsilon_H:
-                
-                R1, T1, R2, T2 = homography_to_RT(H, x1_norm, x2_norm)
-                E1 = compute_E_from_R_and_T(R1, T1)
-                E2 = compute_E_from_R_and_T(R2, T2)
-
-                E1_valid = compute_E_validity(E1)
-                E2_valid = compute_E_validity(E2)
-
-                if E1_valid:
-                    epsilon_E, inliers = compute_E_inliers(E1, x1_norm, x2_norm, err_threshold)
-                        
-                    if epsilon_E > best_epsilon_E:
-                        best_E = np.copy(E1)
-                        best_inliers = np.copy(inliers)
-                        best_epsilon_E = epsilon_E
-                        best_epsilon_H = epsilon_H
-                        T_E = compute_ransac_iterations(alpha, best_epsilon_E, n_E_samples, min_its, max_its, scale_its)
-                        T_H = compute_ransac_iterations(alpha, best_epsilon_H, n_H_samples, min_its, max_its, scale_its)
+                E, epsilon_E, inliers = estimate_E_from_H(H, x1_norm, x2_norm, err_threshold)
+
+                if epsilon_E > best_epsilon_E:
+                    best_E = np.copy(E)
+                    best_inliers = np.copy(inliers)
+                    best_epsilon_E = epsilon_E
+                    best_epsilon_H = epsilon_H
+                    T_E = compute_ransac_iterations(alpha, best_epsilon_E, n_E_samples, min_its, max_its, scale_its)
+                    T_H = compute_ransac_iterations(alpha, best_epsilon_H, n_H_samples, min_its, max_its, scale_its)
+
+                    if verbose:
+                        progress.append((t, T_E, T_H, best_epsilon_E, best_epsilon_H, np.sum(best_inliers), 'H 4-point alg.'))
+
+    # Progress is collected in the RANSAC loop and only printed once it has finished
+    for p in progress:
+        verbose_E_robust(*p)
+    record_ransac('estimate_E_robust', t, best_inliers)
+    return best_E, best_inliers
+
+
+def estimate_E_robust_batched(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, err_threshold_px, batch_size, essential_matrix=True, homography=True, verbose=False, sprt=False, stats=None, sampling='uniform', quality=None, solver='8point', local_optimization=False):
+
+    err_threshold = err_threshold_px / K[0,0]
+    best_E = None
+    best_inliers = None
+    n_points = x1_norm.shape[1]
+    n_E_samples = 5 if solver == '5point' else 8
+    n_H_samples = 4
+    best_epsilon_E = 0
+    best_epsilon_H = 0
+    T_E = max_its
+    T_H = max_its
+    delta = 0
+    n_evaluated_E = []
+    progress = []
 
-                        if verbose:
-                            verbose_E_robust(t, T_E, T_H, best_epsilon_E, best_epsilon_H, best_inliers, method='H 4-point alg.')
-
-                if E2_valid:
-                    epsilon_E, inliers = compute_E_inliers(E2, x1_norm, x2_norm, err_threshold)
-                        
-                    if epsilon_E > best_epsilon_E:
-                        best_E = np.copy(E2)
-                        best_inliers = np.copy(inliers)
-                        best_epsilon_E = epsilon_E
-                        best_epsilon_H = epsilon_H
+    # Samples are drawn without repetition, so too few points cannot give a single hypothesis
+    if n_points < max(n_E_samples if essential_matrix else 0, n_H_samples if homography else 0):
+        return best_E, np.zeros(n_points, dtype=bool)
+
+    if sampling == 'prosac':
+        # Lower quality scores, such as Lowe ratios, are sampled first
+        order = np.argsort(quality, kind='stable')
+        schedule_E = compute_prosac_schedule(n_points, n_E_samples)
+        schedule_H = compute_prosac_schedule(n_points, n_H_samples)
+
+    t = 0
+    while t < T_E and t < T_H:
+        n_batch = int(min(batch_size, T_E - t, T_H - t))
+
+        if essential_matrix:
+            if sampling == 'prosac':
+                samples = draw_prosac_samples(order, n_E_samples, t, n_batch, schedule_E)
+            else:
+                samples = draw_ransac_samples(n_points, n_E_samples, n_batch)
+            x1_samples = x1_norm[:,samples].transpose(1,0,2)
+            x2_samples = x2_norm[:,samples].transpose(1,0,2)
+            if solver == '5point':
+                # All candidate solutions of the batch are scored together
+                E_arr, E_valid = estimate_E_5point_batch(x1_samples, x2_samples)
+                E_arr = E_arr.reshape(-1,3,3)
+                E_valid = E_valid.reshape(-1)
+            else:
+                E_arr = estimate_E_DLT_batch(x1_samples, x2_samples, enforce=True)
+                E_valid = compute_E_validity_batch(E_arr)
+            n_sols = E_arr.shape[0] // n_batch
+
+            epsilon_E_arr = np.zeros(E_arr.shape[0])
+            n_evaluated = np.zeros(E_arr.shape[0], dtype=int)
+            if sprt:
+                E_valid_arr = E_arr[E_valid]
+                inlier_fn = lambda h, p: compute_E_inlier_mask_batch(E_valid_arr[h], np.take(x1_norm, p, axis=1), np.take(x2_norm, p, axis=1), err_threshold)
+                epsilon_E_arr[E_valid], n_evaluated[E_valid], delta = compute_inliers_sprt(inlier_fn, E_valid_arr.shape[0], n_points, best_epsilon_E, delta)
+            else:
+                epsilon_E_arr[E_valid] = compute_E_inliers_batch(E_arr[E_valid], x1_norm, x2_norm, err_threshold)
+                n_evaluated[E_valid] = n_points
+            n_evaluated_E.append(n_evaluated.reshape(n_batch, n_sols).sum(1))
+            best_idx = np.argmax(epsilon_E_arr)
+
+            if epsilon_E_arr[best_idx] > best_epsilon_E:
+                best_E = np.copy(E_arr[best_idx])
+                if local_optimization:
+                    best_E, best_epsilon_E, best_inliers = refine_E_local(best_E, x1_norm, x2_norm, err_threshold)
+                else:
+                    best_epsilon_E, best_inliers = compute_E_inliers(best_E, x1_norm, x2_norm, err_threshold)
+                if sampling == 'prosac':
+                    T_E = compute_prosac_iterations(alpha, best_inliers, order, n_E_samples, min_its, max_its, scale_its)
+                else:
+                    T_E = compute_ransac_iterations(alpha, best_epsilon_E, n_E_samples, min_its, max_its, scale_its)
+
+                if verbose:
+                    progress.append((t+best_idx//n_sols+1, T_E, T_H, best_epsilon_E, best_epsilon_H, np.sum(best_inliers), 'E {}-point alg.'.format(n_E_samples)))
+
+        if homography:
+            if sampling == 'prosac':
+                samples = draw_prosac_samples(order, n_H_samples, t, n_batch, schedule_H)
+            else:
+                samples = draw_ransac_samples(n_points, n_H_samples, n_batch)
+
+            x1_samples = x1_norm[:,samples].transpose(1,0,2)
+            x2_samples = x2_norm[:,samples].transpose(1,0,2)
+            H_arr = estimate_H_DLT_batch(x1_samples, x2_samples)
+            epsilon_H_arr = compute_H_inliers_batch(H_arr, x1_norm, x2_norm, 3*err_threshold)
+
+            # Only homographies that beat the best one are decomposed, all of them at once
+            improving = np.flatnonzero(epsilon_H_arr > best_epsilon_H)
+            if improving.size > 0:
+                E_arr, E_valid = estimate_E_from_H_batch(H_arr[improving], x1_norm, x2_norm)
+                epsilon_E_arr = np.zeros(E_arr.shape[0])
+                epsilon_E_arr[E_valid] = compute_E_inliers_batch(E_arr[E_valid], x1_norm, x2_norm, err_threshold)
+                best_idx = np.argmax(epsilon_E_arr)
+
+                if epsilon_E_arr[best_idx] > best_epsilon_E:
+                    i = improving[best_idx % improving.size]
+                    best_E = np.copy(E_arr[best_idx])
+                    if local_optimization:
+                        best_E, best_epsilon_E, best_inliers = refine_E_local(best_E, x1_norm, x2_norm, err_threshold)
+                    else:
+                        best_epsilon_E, best_inliers = compute_E_inliers(best_E, x1_norm, x2_norm, err_threshold)
+                    best_epsilon_H = epsilon_H_arr[i]
+                    if sampling == 'prosac':
+                        _, inliers_H = compute_H_inliers(H_arr[i], x1_norm, x2_norm, 3*err_threshold)
+                        T_E = compute_prosac_iterations(alpha, best_inliers, order, n_E_samples, min_its, max_its, scale_its)
+                        T_H = compute_prosac_iterations(alpha, inliers_H, order, n_H_samples, min_its, max_its, scale_its)
+                    else:
                         T_E = compute_ransac_iterations(alpha, best_epsilon_E, n_E_samples, min_its, max_its, scale_its)
                         T_H = compute_ransac_iterations(alpha, best_epsilon_H, n_H_samples, min_its, max_its, scale_its)
-                        
-                        if verbose:
-                            verbose_E_robust(t, T_E, T_H, best_epsilon_E, best_epsilon_H, best_inliers, method='H 4-point alg.')
-        
-    print('Bailout at iteration:', t)
+
+                    if verbose:
+                        progress.append((t+i+1, T_E, T_H, best_epsilon_E, best_epsilon_H, np.sum(best_inliers), 'H 4-point alg.'))
+
+        t += n_batch
+
+    for p in progress:
+        verbose_E_robust(*p)
+
+    if stats is not None and n_evaluated_E:
+        stats['n_iterations'] = t
+        stats['n_evaluated'] = np.concatenate(n_evaluated_E)
+
+    record_ransac('estimate_E_robust', t, best_inliers)
     return best_E, best_inliers
 
 
-def triangulate_3D_point_DLT(P1, P2, img1_pts, img2_pts):
-    n = np.size(img1_pts,1)
-    X = []
+def compute_triangulation_matrices(P1, P2, img1_pts, img2_pts):
+    P1 = np.broadcast_to(P1, np.broadcast_shapes(P1.shape, P2.shape))
+    P2 = np.broadcast_to(P2, P1.shape)
 
-    for i in range(n):
+    x1 = img1_pts[0][:,None]
+    y1 = img1_pts[1][:,None]
 
-        x1 = img1_pts[0,i]
-        y1 = img1_pts[1,i]
-        
-        x2 = img2_pts[0,i]
-        y2 = img2_pts[1,i]
+    x2 = img2_pts[0][:,None]
+    y2 = img2_pts[1][:,None]
 
-        M = np.array([[P1[0,0]-x1*P1[2,0], P1[0,1]-x1*P1[2,1], P1[0,2]-x1*P1[2,2], P1[0,3]-x1*P1[2,3]],
-                      [P1[1,0]-y1*P1[2,0], P1[1,1]-y1*P1[2,1], P1[1,2]-y1*P1[2,2], P1[1,3]-y1*P1[2,3]],
-                      [P2[0,0]-x2*P2[2,0], P2[0,1]-x2*P2[2,1], P2[0,2]-x2*P2[2,2], P2[0,3]-x2*P2[2,3]],
-                      [P2[1,0]-y2*P2[2,0], P2[1,1]-y2*P2[2,1], P2[1,2]-y2*P2[2,2], P2[1,3]-y2*P2[2,3]]])
+    P1 = P1[...,None,:,:]
+    P2 = P2[...,None,:,:]
 
-        _, _, VT = LA.svd(M, full_matrices=False)
-        X.append(VT[-1,:])
-        
-    X = dehomogenize(np.stack(X,1))
+    M = np.stack([P1[...,0,:] - x1*P1[...,2,:],
+                  P1[...,1,:] - y1*P1[...,2,:],
+                  P2[...,0,:] - x2*P2[...,2,:],
+                  P2[...,1,:] - y2*P2[...,2,:]], -2)
+    return M # (..., n, 4, 4)
+
+
+def triangulate_3D_points_midpoint(P1, P2, img1_pts, img2_pts):
+    P1 = np.broadcast_to(P1, np.broadcast_shapes(P1.shape, P2.shape))
+    P2 = np.broadcast_to(P2, P1.shape)
+
+    M1_inv = LA.inv(P1[...,:3])
+    M2_inv = LA.inv(P2[...,:3])
+    C1 = -(M1_inv @ P1[...,3:])
+    C2 = -(M2_inv @ P2[...,3:])
+    d1 = M1_inv @ img1_pts
+    d2 = M2_inv @ img2_pts
+
+    w = C1 - C2
+    a = np.sum(d1*d1, axis=-2)
+    b = np.sum(d1*d2, axis=-2)
+    c = np.sum(d2*d2, axis=-2)
+    d = np.sum(d1*w, axis=-2)
+    e = np.sum(d2*w, axis=-2)
+    denom = a*c - b**2
+
+    s1 = (b*e - c*d) / denom
+    s2 = (a*e - b*d) / denom
+    X = (C1 + s1[...,None,:]*d1 + C2 + s2[...,None,:]*d2) / 2
+
+    ones = np.ones(X.shape[:-2] + (1, X.shape[-1]))
+    X = np.concatenate([X, ones], -2)
     return X # in P3
 
 
-def compute_feasible_points(P1, P2, X, percentile, ransac=True):
+def triangulate_3D_points_batch(P1, P2, img1_pts, img2_pts, method='dlt'):
+    if method == 'midpoint':
+        return triangulate_3D_points_midpoint(P1, P2, img1_pts, img2_pts)
+
+    M = compute_triangulation_matrices(P1, P2, img1_pts, img2_pts)
+    _, _, VT = LA.svd(M)
+    X = np.swapaxes(VT[...,-1,:], -1, -2)
+    X = X / X[...,-1:,:]
+    return X # in P3
+
+
+@ins.timed
+def triangulate_3D_point_DLT(P1, P2, img1_pts, img2_pts, method='dlt'):
+    X = triangulate_3D_points_batch(P1, P2, img1_pts, img2_pts, method=method)
+    return X # in P3
+
+
+@ins.timed
+def triangulate_3D_points_multiview(P_obs, x_obs, track_idx, n_tracks):
+    # Tracks of equal length are stacked and solved with one batched SVD
+    X = np.full((4, n_tracks), np.nan)
+    order = np.argsort(track_idx, kind='stable')
+    track_len = np.bincount(track_idx, minlength=n_tracks)
+    track_start = np.concatenate(([0], np.cumsum(track_len)[:-1]))
+
+    for n_views in np.unique(track_len[track_len >= 2]):
+        tracks = np.where(track_len == n_views)[0]
+        obs = order[track_start[tracks][:,None] + np.arange(n_views)] # (n, n_views)
+
+        P = P_obs[obs]
+        x = x_obs[0][obs][...,None]
+        y = x_obs[1][obs][...,None]
+        M = np.concatenate([P[...,0,:] - x*P[...,2,:], P[...,1,:] - y*P[...,2,:]], -2) # (n, 2*n_views, 4)
+
+        _, _, VT = LA.svd(M)
+        X[:,tracks] = (VT[:,-1,:] / VT[:,-1,-1:]).T
+    return X # in P3
+
+
+def compute_track_reprojection_errors(P_obs, x_obs, X, track_idx):
+    x_proj = np.einsum('nij,jn->in', P_obs, X[:,track_idx])
+    depths = x_proj[-1]
+    errors = LA.norm(x_proj[:2] / depths - x_obs[:2], axis=0)
+    return errors, depths
+
+
+def compute_feasible_points(P1, P2, X, percentile, ransac=True, method='percentile', k=16, std_ratio=2.0):
+    if method not in ['percentile', 'statistical']:
+        raise ValueError('Unknown outlier method {}, expected percentile or statistical'.format(method))
+
     if ransac:
         x1 = P1 @ X
         x2 = P2 @ X
         x1_filter = x1[-1,:] > 0
         x2_filter = x2[-1,:] > 0
 
-    X_bar = np.mean(X, axis=1)
-    X_norm = LA.norm(X - X_bar[:,None], axis=0)
-    norm_percentile = np.percentile(X_norm, percentile)
-    outlier_filter = X_norm < norm_percentile
+    if method == 'statistical':
+        # Local density from a KD-tree instead of a global distance to the centroid
+        import point_cloud as pc
+        with np.errstate(divide='ignore', invalid='ignore'):
+            X_3D = X[:-1] / X[-1]
+        finite = np.all(np.isfinite(X_3D), axis=0)
+        outlier_filter = np.zeros(X.shape[1], dtype=bool)
+        outlier_filter[finite] = pc.remove_statistical_outliers(X_3D[:,finite], k=k, std_ratio=std_ratio)
+    else:
+        X_bar = np.mean(X, axis=1)
+        X_norm = LA.norm(X - X_bar[:,None], axis=0)
+        norm_percentile = np.percentile(X_norm, percentile)
+        outlier_filter = X_norm < norm_percentile
 
     if ransac:
         feasible_pts = x1_filter * x2_filter * outlier_filter
@@ -463,8 +1104,8 @@ def extract_P_from_E(E):
     return P_arr
 
 
-def compute_triangulated_X_from_extracted_P2_solutions(P1, P2_arr, x1_norm, x2_norm):
-    X_arr = np.array([triangulate_3D_point_DLT(P1, P2, x1_norm, x2_norm) for P2 in P2_arr])
+def compute_triangulated_X_from_extracted_P2_solutions(P1, P2_arr, x1_norm, x2_norm, method='dlt'):
+    X_arr = triangulate_3D_points_batch(P1, P2_arr, x1_norm, x2_norm, method=method)
     return X_arr
 
 
@@ -547,7 +1188,7 @@ def compute_absolute_rotations(rel_rots, origin_idx, verbose=False):
     for i in range(len(abs_rots)):
 
         Ri = abs_rots[i]
-        Ri = LA.inv(R0) @ Ri
+        Ri = Ri @ LA.inv(R0)
         abs_rots[i] = Ri
 
         if verbose:
@@ -556,37 +1197,216 @@ def compute_absolute_rotations(rel_rots, origin_idx, verbose=False):
     return np.array(abs_rots)
 
 
-def estimate_T_least_squares(R, X_pts, x_pts):
-    n = x_pts.shape[1]
-    A = []
-    B = []
+def project_to_rotations(M_arr):
+    U, _, VT = LA.svd(M_arr)
+    D = np.ones(M_arr.shape[:-1])
+    D[...,-1] = np.sign(LA.det(U @ VT))
+    R_arr = (U * D[...,None,:]) @ VT
+    return R_arr
+
+
+def compute_spectral_rotations(n_cams, pairs, rel_rots, weights):
+    from scipy import sparse
+    from scipy.sparse import linalg as sparse_linalg
+
+    # With R_j = R_ij R_i, the block matrix G with blocks G_ji = w_ij R_ij is close to R R^T for the stacked R
+    pairs = np.asarray(pairs)
+    rows = []
+    cols = []
+    vals = []
+    for (i, j), R_ij, w in zip(pairs, rel_rots, weights):
+        for a in range(3):
+            for b in range(3):
+                rows += [3*j+a, 3*i+b]
+                cols += [3*i+b, 3*j+a]
+                vals += [w*R_ij[a,b], w*R_ij[a,b]]
+    G = sparse.csr_matrix((vals, (rows, cols)), shape=(3*n_cams, 3*n_cams))
+
+    if n_cams > 10:
+        _, V = sparse_linalg.eigsh(G, k=3, which='LA')
+    else:
+        _, V = LA.eigh(G.toarray())
+        V = V[:,-3:]
+
+    V = V.reshape(n_cams, 3, 3)
+    if np.sum(LA.det(V) < 0) > n_cams / 2:
+        V = -V
+    R_arr = project_to_rotations(V)
+    return R_arr
+
+
+def refine_global_rotations(R_arr, pairs, rel_rots, weights, origin_idx, n_its=20, cauchy_scale=np.deg2rad(5), tol=1e-8, verbose=False):
+    from scipy import sparse
+    from scipy.sparse import linalg as sparse_linalg
+    from scipy.spatial.transform import Rotation
+
+    # IRLS in the tangent space with R_i <- R_i exp([d_i]): log(R_j^T R_ij R_i) ~ d_j - d_i
+    pairs = np.asarray(pairs)
+    n_cams = R_arr.shape[0]
+    n_pairs = pairs.shape[0]
+    free_cams = np.delete(np.arange(n_cams), origin_idx)
+    col_idx = np.full(n_cams, -1)
+    col_idx[free_cams] = np.arange(free_cams.shape[0])
+
+    rows = np.arange(3*n_pairs).reshape(n_pairs, 3)
+    A_rows = np.concatenate([rows.ravel(), rows.ravel()])
+    A_cols = np.concatenate([(3*col_idx[pairs[:,1]][:,None] + np.arange(3)).ravel(), (3*col_idx[pairs[:,0]][:,None] + np.arange(3)).ravel()])
+    A_vals = np.concatenate([np.ones(3*n_pairs), -np.ones(3*n_pairs)])
+    keep = A_cols >= 0
+    A = sparse.csr_matrix((A_vals[keep], (A_rows[keep], A_cols[keep])), shape=(3*n_pairs, 3*free_cams.shape[0]))
+
+    for it in range(n_its):
+        F = np.swapaxes(R_arr[pairs[:,1]],1,2) @ rel_rots @ R_arr[pairs[:,0]]
+        r = Rotation.from_matrix(F).as_rotvec()
+        r_norm = LA.norm(r, axis=1)
+        robust_weights = weights * cauchy_scale**2 / (cauchy_scale**2 + r_norm**2)
+
+        W = sparse.diags(np.repeat(robust_weights, 3))
+        delta = sparse_linalg.spsolve((A.T @ W @ A).tocsc(), A.T @ (W @ r.ravel()))
+        delta = np.asarray(delta).reshape(-1, 3)
+        R_arr[free_cams] = R_arr[free_cams] @ Rotation.from_rotvec(delta).as_matrix()
 
-    for i in range(n):
+        if verbose:
+            print('Iteration:', it+1, 'Median residual (deg):', np.round(np.rad2deg(np.median(r_norm)), 4), 'Max update (deg):', np.round(np.rad2deg(np.max(np.abs(delta))), 6))
+        if np.max(np.abs(delta)) < tol:
+            break
 
-        x1 = x_pts[0,i]
-        x2 = x_pts[1,i]
+    return R_arr
 
-        X = R @ X_pts[:,i]
-        X1 = X[0]
-        X2 = X[1]
-        X3 = X[2]
 
-        a = np.array([[1, 0, -x1],
-                      [0, 1, -x2]])
-        
-        b = np.array([[X3*x1 - X1],
-                      [X3*x2 - X2]])
+@ins.timed
+def compute_global_rotations(n_cams, pairs, rel_rots, weights, origin_idx, n_its=20, verbose=False):
+    rel_rots = project_to_rotations(np.asarray(rel_rots, dtype=float))
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / np.max(weights)
+
+    R_arr = compute_spectral_rotations(n_cams, pairs, rel_rots, weights)
+    R_arr = R_arr @ R_arr[origin_idx].T
+    R_arr = refine_global_rotations(R_arr, pairs, rel_rots, weights, origin_idx, n_its=n_its, verbose=verbose)
+    R_arr = R_arr @ R_arr[origin_idx].T
+    return R_arr
+
+
+def compute_rotations_from_quaternions(q_arr):
+    from scipy.spatial.transform import Rotation
+    R_arr = Rotation.from_quat(q_arr).as_matrix()
+    return R_arr
+
+
+def compute_rotation_quaternion_jacobians(q_arr):
+    q_norm = LA.norm(q_arr, axis=1)
+    u = q_arr / q_norm[:,None]
+    x, y, z, w = u.T
+    zero = np.zeros_like(x)
+
+    # dR/du for the unit quaternion u = (x, y, z, w), shape (n, 3, 3, 4)
+    dR_du = 2*np.stack([
+        np.stack([np.stack([zero, -2*y, -2*z, zero], -1),
+                  np.stack([y, x, -w, -z], -1),
+                  np.stack([z, w, x, y], -1)], 1),
+        np.stack([np.stack([y, x, w, z], -1),
+                  np.stack([-2*x, zero, -2*z, zero], -1),
+                  np.stack([-w, z, y, -x], -1)], 1),
+        np.stack([np.stack([z, -w, x, -y], -1),
+                  np.stack([w, z, y, x], -1),
+                  np.stack([-2*x, -2*y, zero, zero], -1)], 1)], 1)
+
+    du_dq = (np.eye(4) - u[:,:,None] * u[:,None,:]) / q_norm[:,None,None]
+    dR_dq = dR_du @ du_dq[:,None,:,:]
+    return dR_dq # (n, 3, 3, 4)
+
+
+def compute_T_least_squares_systems(RX, x_pts):
+    x1 = x_pts[...,0,:]
+    x2 = x_pts[...,1,:]
+    ones = np.ones_like(x1)
+    zeros = np.zeros_like(x1)
+
+    # Two rows per point, [1, 0, -x1] T = X3*x1 - X1 and [0, 1, -x2] T = X3*x2 - X2
+    A = np.concatenate([np.stack([ones, zeros, -x1], -1), np.stack([zeros, ones, -x2], -1)], -2)
+    b = np.concatenate([RX[...,2,:]*x1 - RX[...,0,:], RX[...,2,:]*x2 - RX[...,1,:]], -1)
+    return A, b # (..., 2n, 3), (..., 2n)
 
-        A.append(a)
-        B.append(b)
 
-    A = np.concatenate(A, 0)
-    B = np.concatenate(B, 0)
-    T = LA.lstsq(A, B, rcond=None)[0].flatten()
+def estimate_T_least_squares(R, X_pts, x_pts):
+    A, b = compute_T_least_squares_systems(R @ X_pts, x_pts)
+    T = LA.lstsq(A, b, rcond=None)[0]
     return T
 
 
-def estimate_T_robust(K, R, X, x_norm, min_its, max_its, scale_its, alpha, err_threshold_px, verbose=False):
+def estimate_T_least_squares_batch(RX, x_pts):
+    A, b = compute_T_least_squares_systems(RX, x_pts)
+    T_arr = (LA.pinv(A) @ b[...,None])[...,0]
+    return T_arr # (B, 3)
+
+
+def compute_T_inlier_mask_batch(T_arr, RX, x_norm, err_threshold):
+    Y = RX[None] + T_arr[:,:,None]
+    distance_arr2 = np.sum((Y[:,:2] / Y[:,2:3] - x_norm[None,:2])**2, axis=1)
+    return distance_arr2 < err_threshold**2
+
+
+def compute_T_inliers_batch(T_arr, RX, x_norm, err_threshold, max_chunk_elements=MAX_CHUNK_ELEMENTS):
+    n_points = x_norm.shape[1]
+    chunk_size = max(1, max_chunk_elements // max(n_points, 1))
+    n_inliers = np.zeros(T_arr.shape[0], dtype=int)
+
+    for start in range(0, T_arr.shape[0], chunk_size):
+        inliers = compute_T_inlier_mask_batch(T_arr[start:start+chunk_size], RX, x_norm, err_threshold)
+        n_inliers[start:start+chunk_size] = np.sum(inliers, axis=1)
+
+    epsilon_arr = n_inliers / n_points
+    return epsilon_arr
+
+
+def compute_T_inliers(T, RX, x_norm, err_threshold):
+    x_norm_proj = dehomogenize(RX + T[:,None])
+    distance_arr = compute_point_point_distance(x_norm_proj, x_norm)
+    inliers = distance_arr < err_threshold
+    epsilon = np.sum(inliers) / x_norm.shape[1]
+    return epsilon, inliers
+
+
+def refine_T_local(T, RX, x_norm, err_threshold, n_its=4, threshold_scale=3):
+    # Iteratively reweighted least squares on the inliers of a shrinking threshold (LO-RANSAC)
+    best_T = T
+    best_epsilon, best_inliers = compute_T_inliers(T, RX, x_norm, err_threshold)
+
+    for threshold in np.linspace(threshold_scale*err_threshold, err_threshold, n_its):
+        distance_arr = compute_point_point_distance(dehomogenize(RX + T[:,None]), x_norm)
+        inliers = distance_arr < threshold
+        if np.sum(inliers) < 2:
+            break
+
+        # Cauchy weights on the residuals of the previous fit, one per row of the 2x3 point blocks
+        weights = np.sqrt(1 / (1 + distance_arr[inliers]**2 / err_threshold**2))
+        A, b = compute_T_least_squares_systems(RX[:,inliers], x_norm[:,inliers])
+        weights = np.concatenate([weights, weights])
+        T = LA.lstsq(weights[:,None] * A, weights * b, rcond=None)[0]
+
+        epsilon, inliers = compute_T_inliers(T, RX, x_norm, err_threshold)
+        if epsilon > best_epsilon:
+            best_T, best_epsilon, best_inliers = T, epsilon, inliers
+
+    return best_T, best_epsilon, best_inliers
+
+
+@ins.timed
+def estimate_T_robust(K, R, X, x_norm, min_its, max_its, scale_its, alpha, err_threshold_px, verbose=False, batch_size=None, sprt=False, stats=None, sampling='uniform', quality=None, local_optimization=False):
+
+    if sampling not in ['uniform', 'prosac']:
+        raise ValueError('Unknown sampling {}, expected uniform or prosac'.format(sampling))
+    if sampling == 'prosac' and (batch_size is None or quality is None):
+        raise ValueError('PROSAC sampling requires a batch size and match quality scores')
+    if local_optimization and batch_size is None:
+        raise ValueError('Local optimization requires a batch size')
+    if sprt and batch_size is None:
+        raise ValueError('SPRT requires a batch size')
+    if stats is not None and batch_size is None:
+        raise ValueError('Collecting stats requires a batch size')
+
+    if batch_size is not None:
+        return estimate_T_robust_batched(K, R, X, x_norm, min_its, max_its, scale_its, alpha, err_threshold_px, batch_size, verbose=verbose, sprt=sprt, stats=stats, sampling=sampling, quality=quality, local_optimization=local_optimization)
     
     err_threshold = err_threshold_px / K[0,0]
     best_T = np.full(3, np.nan)
@@ -595,6 +1415,7 @@ def estimate_T_robust(K, R, X, x_norm, min_its, max_its, scale_its, alpha, err_t
     n_points = x_norm.shape[1]
     n_samples = 2
     ransac_its = max_its
+    progress = []
 
     t = 0
     while t < ransac_its:
@@ -615,12 +1436,118 @@ def estimate_T_robust(K, R, X, x_norm, min_its, max_its, scale_its, alpha, err_t
             best_epsilon = epsilon
             ransac_its = compute_ransac_iterations(alpha, best_epsilon, n_samples, min_its, max_its, scale_its)
             if verbose:
-                print('Iteration:', t, 'T:', ransac_its, 'epsilon:', np.round(best_epsilon, 2), 'No. inliers:', np.sum(inliers))
-    
-    print('Bailout at iteration:', t)
+                progress.append((t, ransac_its, best_epsilon, n_inliers))
+
+    for p in progress:
+        verbose_T_robust(*p)
+    record_ransac('estimate_T_robust', t, best_inliers)
+    return best_T, best_inliers
+
+
+def estimate_T_robust_batched(K, R, X, x_norm, min_its, max_its, scale_its, alpha, err_threshold_px, batch_size, verbose=False, sprt=False, stats=None, sampling='uniform', quality=None, local_optimization=False):
+
+    err_threshold = err_threshold_px / K[0,0]
+    best_T = np.full(3, np.nan)
+    best_inliers = np.zeros(x_norm.shape[1], dtype=bool)
+    best_epsilon = 0
+    n_points = x_norm.shape[1]
+    n_samples = 2
+    ransac_its = max_its
+
+    if n_points < n_samples:
+        return best_T, best_inliers
+
+    # Rotation is known, so every hypothesis only needs the rotated points
+    RX = R @ X
+    delta = 0
+    n_evaluated_T = []
+    progress = []
+
+    if sampling == 'prosac':
+        order = np.argsort(quality, kind='stable')
+        schedule = compute_prosac_schedule(n_points, n_samples)
+
+    t = 0
+    while t < ransac_its:
+        n_batch = int(min(batch_size, ransac_its - t))
+
+        if sampling == 'prosac':
+            samples = draw_prosac_samples(order, n_samples, t, n_batch, schedule)
+        else:
+            samples = draw_ransac_samples(n_points, n_samples, n_batch)
+        RX_samples = RX[:,samples].transpose(1,0,2)
+        x_samples = x_norm[:,samples].transpose(1,0,2)
+        T_arr = estimate_T_least_squares_batch(RX_samples, x_samples)
+
+        if sprt:
+            inlier_fn = lambda h, p: compute_T_inlier_mask_batch(T_arr[h], np.take(RX, p, axis=1), np.take(x_norm, p, axis=1), err_threshold)
+            epsilon_arr, n_evaluated, delta = compute_inliers_sprt(inlier_fn, n_batch, n_points, best_epsilon, delta)
+        else:
+            epsilon_arr = compute_T_inliers_batch(T_arr, RX, x_norm, err_threshold)
+            n_evaluated = np.full(n_batch, n_points)
+        n_evaluated_T.append(n_evaluated)
+        best_idx = np.argmax(epsilon_arr)
+
+        if epsilon_arr[best_idx] > best_epsilon:
+            best_T = np.copy(T_arr[best_idx])
+            if local_optimization:
+                best_T, best_epsilon, best_inliers = refine_T_local(best_T, RX, x_norm, err_threshold)
+            else:
+                best_epsilon, best_inliers = compute_T_inliers(best_T, RX, x_norm, err_threshold)
+            if sampling == 'prosac':
+                ransac_its = compute_prosac_iterations(alpha, best_inliers, order, n_samples, min_its, max_its, scale_its)
+            else:
+                ransac_its = compute_ransac_iterations(alpha, best_epsilon, n_samples, min_its, max_its, scale_its)
+            if verbose:
+                progress.append((t+best_idx+1, ransac_its, best_epsilon, np.sum(best_inliers)))
+
+        t += n_batch
+
+    for p in progress:
+        verbose_T_robust(*p)
+
+    # Refit on all inliers, kept only if it does not lose inliers
+    if np.sum(best_inliers) >= n_samples:
+        T = estimate_T_least_squares(R, X[:,best_inliers], x_norm[:,best_inliers])
+        epsilon, inliers = compute_T_inliers(T, RX, x_norm, err_threshold)
+        if epsilon >= best_epsilon:
+            best_T, best_epsilon, best_inliers = T, epsilon, inliers
+            if verbose:
+                print('Least squares refit, epsilon:', np.round(best_epsilon, 2), 'No. inliers:', np.sum(best_inliers))
+
+    if stats is not None:
+        stats['n_iterations'] = t
+        stats['n_evaluated'] = np.concatenate(n_evaluated_T)
+
+    record_ransac('estimate_T_robust', t, best_inliers)
     return best_T, best_inliers
 
 
+@ins.timed
+def estimate_pose_PnP_robust(K, X, x_norm, max_its, alpha, err_threshold_px, verbose=False):
+    err_threshold = err_threshold_px / K[0,0]
+    n_points = x_norm.shape[1]
+
+    if n_points < 4:
+        return None, None, np.zeros(n_points, dtype=bool)
+
+    X_pts = np.ascontiguousarray(X[:3].T, dtype=np.float64)
+    x_pts = np.ascontiguousarray(x_norm[:2].T, dtype=np.float64)
+    success, rvec, tvec, inlier_idx = cv2.solvePnPRansac(X_pts, x_pts, np.eye(3), None, iterationsCount=int(max_its), reprojectionError=err_threshold, confidence=alpha)
+
+    inliers = np.zeros(n_points, dtype=bool)
+    if not success or inlier_idx is None:
+        return None, None, inliers
+
+    inliers[inlier_idx.ravel()] = True
+    R = cv2.Rodrigues(rvec)[0]
+    T = tvec.ravel()
+
+    if verbose:
+        print('PnP inliers:', np.sum(inliers), '/', n_points)
+    return R, T, inliers
+
+
 def plot_cameras_and_axes(ax, C_list, axis_list, s, valid_idx, col):
 
     for i in range(np.size(C_list,1)):
@@ -635,9 +1562,34 @@ def plot_cameras_and_axes(ax, C_list, axis_list, s, valid_idx, col):
         ax.plot([x_axis, C[0]], [y_axis, C[1]], [z_axis, C[2]], '-', color=col[i], lw=3, alpha=0.7)
 
 
-def plot_cameras_and_3D_points(X_arr, C_arr, axis_arr, s, title, valid_idx, multi=False):
-    fig = plt.figure(figsize=(12,8))
-    ax = plt.axes(projection='3d')
+def create_3D_figure(figsize=None, save_path=None):
+    # Figures rendered to file never touch pyplot, so no display or interactive backend is needed
+    if save_path is not None:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=figsize)
+    else:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=figsize)
+    ax = fig.add_subplot(projection='3d')
+    return fig, ax
+
+
+def show_figure(fig, save_path=None):
+    if save_path is not None:
+        dirname = os.path.dirname(save_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        fig.savefig(save_path, dpi=150)
+        print('Saved plot to', save_path)
+    else:
+        import matplotlib.pyplot as plt
+        plt.show()
+
+
+def plot_cameras_and_3D_points(X_arr, C_arr, axis_arr, s, title, valid_idx, multi=False, save_path=None):
+    from matplotlib import cm
+
+    fig, ax = create_3D_figure(figsize=(12,8), save_path=save_path)
     col = cm.rainbow(np.linspace(0, 1, np.size(C_arr,1)))
 
     if multi:
@@ -654,13 +1606,12 @@ def plot_cameras_and_3D_points(X_arr, C_arr, axis_arr, s, title, valid_idx, mult
     ax.set_aspect('equal')
     ax.set_title(title)
     fig.tight_layout()
-    plt.legend(loc="lower right")
-    plt.show()
+    ax.legend(loc="lower right")
+    show_figure(fig, save_path=save_path)
 
 
-def plot_3D_points(X):
-    fig = plt.figure()
-    ax = plt.axes(projection='3d')
+def plot_3D_points(X, save_path=None):
+    fig, ax = create_3D_figure(save_path=save_path)
     ax.plot(X[0], X[1], X[2], '.', ms=1, color='magenta', label='X')
     ax.set_xlabel('$x$')
     ax.set_ylabel('$y$')
@@ -668,4 +1619,4 @@ def plot_3D_points(X):
     ax.set_aspect('equal')
     ax.legend(loc="lower right")
     fig.tight_layout()
-    plt.show()
\ No newline at end of file
+    show_figure(fig, save_path=save_path)
@@ -0,0 +1,123 @@
+import computer_vision as cv
+import numpy as np
+import os
+import struct
+
+
+PLY_COUNT_WIDTH = 12
+NPY_HEADER_LEN = 128
+
+
+def ply_header(n_pts):
+    # The vertex count is zero-padded to a fixed width so it can be patched in place on close
+    return ('ply\n'
+            'format binary_little_endian 1.0\n'
+            'element vertex {:0{}d}\n'
+            'property float x\n'
+            'property float y\n'
+            'property float z\n'
+            'end_header\n').format(n_pts, PLY_COUNT_WIDTH).encode('ascii')
+
+
+def npy_header(n_pts):
+    # Padded to a fixed length for the same reason, version 1.0 stores the header length in 2 bytes
+    header = "{{'descr': '<f4', 'fortran_order': False, 'shape': ({}, 3), }}".format(n_pts)
+    header = header.ljust(NPY_HEADER_LEN - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class PointCloudWriter:
+
+    def __init__(self, path, formats=('ply', 'npy')):
+        unknown = set(formats) - {'ply', 'npy'}
+        if unknown:
+            raise ValueError('Unknown export formats {}, expected ply or npy'.format(sorted(unknown)))
+
+        self.path = path
+        self.formats = tuple(formats)
+        self.n_pts = 0
+        self.files = {}
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        for fmt in self.formats:
+            f = open(self.point_path(fmt), 'wb')
+            f.write(ply_header(0) if fmt == 'ply' else npy_header(0))
+            self.files[fmt] = f
+
+    def point_path(self, fmt):
+        return '{}.{}'.format(self.path, fmt)
+
+    def camera_path(self):
+        return '{}_cameras.npz'.format(self.path)
+
+    def write_points(self, X):
+        # X is (3, n) or homogeneous (4, n), written as contiguous little endian float32 rows
+        X = np.asarray(X)
+        if X.shape[0] == 4:
+            X = cv.dehomogenize(X)[:-1]
+        rows = np.ascontiguousarray(X.T, dtype='<f4')
+        for f in self.files.values():
+            f.write(rows.tobytes())
+        self.n_pts += rows.shape[0]
+
+    def write_cameras(self, cameras, valid_idx, K=None, img_names=None):
+        cameras = np.asarray(cameras, dtype=float)
+        centers = np.array([cv.compute_camera_center(P) for P in cameras])
+        axes = np.array([cv.compute_normalized_principal_axis(P) for P in cameras])
+        arrays = {'cameras': cameras, 'valid_idx': np.asarray(valid_idx), 'centers': centers, 'axes': axes}
+        if K is not None:
+            arrays['K'] = K
+        if img_names is not None:
+            arrays['img_names'] = np.array(img_names)
+        np.savez_compressed(self.camera_path(), **arrays)
+
+    def close(self):
+        for fmt, f in self.files.items():
+            f.seek(0)
+            f.write(ply_header(self.n_pts) if fmt == 'ply' else npy_header(self.n_pts))
+            f.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_ply_header(path):
+    n_pts = None
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError('{} is not a PLY file'.format(path))
+        while True:
+            words = f.readline().split()
+            if not words:
+                raise ValueError('{} has no end_header'.format(path))
+            if words[0] == b'format' and words[1] != b'binary_little_endian':
+                raise ValueError('Only binary little endian PLY files can be memory-mapped')
+            if words[:2] == [b'element', b'vertex']:
+                n_pts = int(words[2])
+            if words[0] == b'end_header':
+                return n_pts, f.tell()
+
+
+def read_points(path, mmap=True):
+    # Returns a (3, n) view onto the file, rows are only paged in when accessed
+    mmap_mode = 'r' if mmap else None
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode=mmap_mode).T
+
+    n_pts, offset = read_ply_header(path)
+    if mmap:
+        rows = np.memmap(path, dtype='<f4', mode='r', offset=offset, shape=(n_pts, 3))
+    else:
+        rows = np.fromfile(path, dtype='<f4', count=3*n_pts, offset=offset).reshape(n_pts, 3)
+    return rows.T
+
+
+def read_cameras(path):
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
@@ -0,0 +1,78 @@
+import computer_vision as cv
+import hashlib
+import images as im
+import json
+import numpy as np
+import os
+
+
+class FeatureStore:
+
+    def __init__(self, img_names, cache_dir=None, sift_params=None, verbose=False, images=None):
+        if images is None:
+            images = im.ImageSource(img_names, grayscale=True)
+
+        self.img_names = list(img_names)
+        self.images = images
+        self.cache_dir = cache_dir
+        self.sift_params = dict(sift_params) if sift_params is not None else {}
+        self.verbose = verbose
+        self._keys = {}
+        self._features = {}
+        self._indices = {}
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.img_names)
+
+    def __getitem__(self, i):
+        key = self.key(i)
+        if key not in self._features:
+            self._features[key] = self._load_or_detect(i, key)
+        return self._features[key]
+
+    def index(self, i):
+        key = self.key(i)
+        if key not in self._indices:
+            _, des = self[i]
+            self._indices[key] = cv.build_flann_index(des)
+        return self._indices[key]
+
+    def key(self, i):
+        if i not in self._keys:
+            path = self.img_names[i]
+            with open(path, 'rb') as f:
+                content_hash = hashlib.sha1(f.read()).hexdigest()
+            params = json.dumps(self.sift_params, sort_keys=True)
+            identity = '|'.join([os.path.abspath(path), content_hash, 'scale={}'.format(self.images.scale), 'SIFT', params])
+            self._keys[i] = hashlib.sha1(identity.encode()).hexdigest()
+        return self._keys[i]
+
+    def cache_path(self, i):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, self.key(i) + '.npz')
+
+    def _load_or_detect(self, i, key):
+        path = self.cache_path(i)
+
+        if path is not None and os.path.exists(path):
+            with np.load(path) as data:
+                pts, des = data['pts'], data['des']
+            if self.verbose:
+                print('Loaded', pts.shape[1], 'cached features for', self.img_names[i])
+            return pts, des
+
+        img = self.images[i]
+        pts, des = cv.detect_sift_points(img, self.sift_params)
+        pts = self.images.to_full_resolution(pts)
+        if self.verbose:
+            print('Detected', pts.shape[1], 'features in', self.img_names[i])
+
+        if path is not None:
+            tmp_path = path + '.tmp.npz'
+            np.savez(tmp_path, pts=pts, des=des)
+            os.replace(tmp_path, path)
+        return pts, des
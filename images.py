@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import cv2
+
+
+REDUCED_COLOR_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+REDUCED_GRAYSCALE_FLAGS = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+class ImageSource:
+
+    def __init__(self, img_names, grayscale=False, scale=1, max_bytes=256*2**20):
+        if scale not in REDUCED_COLOR_FLAGS:
+            raise ValueError('Image scale must be one of {}, got {}'.format(sorted(REDUCED_COLOR_FLAGS), scale))
+
+        self.img_names = list(img_names)
+        self.grayscale = grayscale
+        self.scale = scale
+        self.max_bytes = max_bytes
+        self.flags = REDUCED_GRAYSCALE_FLAGS[scale] if grayscale else REDUCED_COLOR_FLAGS[scale]
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+    def __len__(self):
+        return len(self.img_names)
+
+    @property
+    def shape(self):
+        return (len(self),) + self[0].shape
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('Image index {} out of range for {} images'.format(i, len(self)))
+
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+
+        img = self.read(i)
+        self._cache[i] = img
+        self._cache_bytes += img.nbytes
+
+        # Evict least recently used frames, but always keep the one just decoded
+        while self._cache_bytes > self.max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes
+        return img
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def read(self, i):
+        img = cv2.imread(self.img_names[i], self.flags)
+        if img is None:
+            raise IOError('Could not read image {}'.format(self.img_names[i]))
+        return img
+
+    def to_full_resolution(self, pts):
+        # Pixel centers of a reduced decode map back to the center of a scale x scale block
+        return (pts + 0.5) * self.scale - 0.5
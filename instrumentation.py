@@ -0,0 +1,217 @@
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_recorder = None
+
+
+def get_recorder():
+    return _recorder
+
+
+def set_recorder(recorder):
+    global _recorder
+    _recorder = recorder
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def summarize_values(values):
+    values = [float(v) for v in values]
+    return {'sum': sum(values), 'mean': sum(values) / len(values), 'min': min(values), 'max': max(values)}
+
+
+class KernelRecord:
+
+    def __init__(self):
+        self.n_calls = 0
+        self.n_worker_calls = 0
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.values = {}
+
+    def add_time(self, wall_s, cpu_s):
+        self.n_calls += 1
+        self.wall_s += wall_s
+        self.cpu_s += cpu_s
+
+    def add_values(self, values):
+        for k, v in values.items():
+            self.values.setdefault(k, []).append(v)
+
+    def merge(self, other):
+        # Calls made in worker processes are counted separately, their times overlap with each other
+        self.n_calls += other.n_calls
+        self.n_worker_calls += other.n_calls
+        self.wall_s += other.wall_s
+        self.cpu_s += other.cpu_s
+        for k, v in other.values.items():
+            self.values.setdefault(k, []).extend(v)
+
+    def to_dict(self):
+        return {'n_calls': self.n_calls, 'n_worker_calls': self.n_worker_calls, 'wall_s': self.wall_s, 'cpu_s': self.cpu_s,
+                'values': {k: summarize_values(v) for k, v in self.values.items()}}
+
+
+class Recorder:
+
+    def __init__(self, profile_dir=None, trace_memory=False, n_profile_lines=25):
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.n_profile_lines = n_profile_lines
+        self.stages = []
+        self.kernels = {}
+        self.start_time = time.time()
+        self._stage_kernels = None
+        self._stage_worker_rss_mb = None
+        self._depth = 0
+
+    def kernel(self, name):
+        # Kernels are aggregated per stage and over the whole run
+        records = [self.kernels]
+        if self._stage_kernels is not None:
+            records.append(self._stage_kernels)
+        return [r.setdefault(name, KernelRecord()) for r in records]
+
+    def add_time(self, name, wall_s, cpu_s):
+        for record in self.kernel(name):
+            record.add_time(wall_s, cpu_s)
+
+    def add_values(self, name, values):
+        for record in self.kernel(name):
+            record.add_values(values)
+
+    def merge_kernels(self, kernels, worker_peak_rss_mb=None):
+        for name, other in kernels.items():
+            for record in self.kernel(name):
+                record.merge(other)
+        if worker_peak_rss_mb is not None and self._depth > 0:
+            self._stage_worker_rss_mb = max(self._stage_worker_rss_mb or 0, worker_peak_rss_mb)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Only the outermost stage is profiled and traced, nested stages are folded into it
+        outermost = self._depth == 0
+        self._depth += 1
+        if outermost:
+            self._stage_kernels = {}
+            self._stage_worker_rss_mb = None
+            profiler = cProfile.Profile() if self.profile_dir is not None else None
+            if self.trace_memory:
+                tracemalloc.start()
+            if profiler is not None:
+                profiler.enable()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        rss_start = get_peak_rss_mb()
+        try:
+            yield
+        finally:
+            wall_s = time.perf_counter() - wall_start
+            cpu_s = time.process_time() - cpu_start
+            self._depth -= 1
+
+            if outermost:
+                # The peak RSS of a process only grows, so a stage is charged with how much it raised it
+                process_peak_rss_mb = get_peak_rss_mb()
+                entry = {'name': name, 'wall_s': wall_s, 'cpu_s': cpu_s, 'process_peak_rss_mb': process_peak_rss_mb,
+                         'peak_rss_increase_mb': process_peak_rss_mb - rss_start if rss_start is not None else None}
+                if profiler is not None:
+                    profiler.disable()
+                    entry['profile'] = self.save_profile(profiler, name)
+                if self.trace_memory:
+                    entry['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+                    tracemalloc.stop()
+                if self._stage_worker_rss_mb is not None:
+                    entry['worker_peak_rss_mb'] = self._stage_worker_rss_mb
+                entry['kernels'] = {k: r.to_dict() for k, r in self._stage_kernels.items()}
+                self._stage_kernels = None
+                self.stages.append(entry)
+
+    def save_profile(self, profiler, name):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, '{:02d}_{}.prof'.format(len(self.stages), name))
+        profiler.dump_stats(path)
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(self.n_profile_lines)
+        return {'path': path, 'top_cumulative': stream.getvalue().splitlines()}
+
+    def report(self):
+        return {'start_time': self.start_time, 'wall_s': time.time() - self.start_time, 'process_peak_rss_mb': get_peak_rss_mb(),
+                'stages': self.stages, 'kernels': {k: r.to_dict() for k, r in self.kernels.items()}}
+
+    def save(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+@contextlib.contextmanager
+def stage(name):
+    # Also usable as a decorator, the recorder is looked up on every call
+    if _recorder is None:
+        yield
+    else:
+        with _recorder.stage(name):
+            yield
+
+
+def timed(fn):
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _recorder is None:
+            return fn(*args, **kwargs)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _recorder.add_time(name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+    return wrapper
+
+
+def record(name, **values):
+    if _recorder is not None:
+        _recorder.add_values(name, values)
+
+
+def run_recorded(fn, *args, **kwargs):
+    # Runs fn in a worker process with its own recorder, the kernel records are returned for the parent to merge
+    global _recorder
+    previous = _recorder
+    _recorder = Recorder()
+    try:
+        result = fn(*args, **kwargs)
+        return result, _recorder.kernels, get_peak_rss_mb()
+    finally:
+        _recorder = previous
+
+
+def merge_worker_kernels(kernels, worker_peak_rss_mb=None):
+    if _recorder is not None:
+        _recorder.merge_kernels(kernels, worker_peak_rss_mb)
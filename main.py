@@ -1,28 +1,131 @@
 import argparse
-import computer_vision as cv
+import checkpoint as ck
+import export as ex
+import features as ft
 import get_dataset_info as dataset
+import images as im
+import instrumentation as ins
 from numpy import linalg as LA
+import numpy as np
+import os
 import pipeline as pl
+import reconstruction_map as rm
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-dataset', type=int, required=True)
-args = parser.parse_args()
-print('Dataset:', args.dataset)
-
-print('\n\n\n### Initializing ###\n')
-data_set = args.dataset-1
-K, img_names, init_pair, pixel_threshold = dataset.get_dataset_info(data_set)
-K_inv = LA.inv(K)
-imgs = cv.load_image(img_names, multi=True)
-n_imgs = imgs.shape[0]
-n_camera_pairs = n_imgs-1
-
-abs_rots, x1_norm_RA, x2_norm_RA, inliers_RA = pl.compute_rotation_averaging(imgs, init_pair, K, pixel_threshold, plot=False)
-x1_init_norm_feasible_inliers, x2_init_norm_feasible_inliers, des1_init_feasible_inliers, des2_init_feasible_inliers, X_init_feasible_inliers, X_init_idx = pl.compute_initial_3D_points(imgs, init_pair, K, 3*pixel_threshold, plot=False)
-trans, valid_cameras, x_norm_TR, X_idx_TR, inliers_TR = pl.compute_translation_registration(K, imgs, init_pair, 3*pixel_threshold, abs_rots, x1_init_norm_feasible_inliers, x2_init_norm_feasible_inliers, des1_init_feasible_inliers, X_init_feasible_inliers, X_init_idx)
-abs_rots_opt, trans_opt = pl.refine_rotations_and_translations(trans, abs_rots, X_init_feasible_inliers, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR)
-cameras = pl.create_cameras(abs_rots, trans)
-cameras_opt = pl.create_cameras(abs_rots_opt, trans_opt)
-pl.triangulate_final_3D_reconstruction(imgs, K, pixel_threshold, cameras, valid_cameras, inliers_RA, x1_norm_RA, x2_norm_RA, 'Final 3D Reconstruction with LM=False')
-pl.triangulate_final_3D_reconstruction(imgs, K, pixel_threshold, cameras_opt, valid_cameras, inliers_RA, x1_norm_RA, x2_norm_RA, 'Final 3D Reconstruction with LM=True')
\ No newline at end of file
+def plot_path(args, name):
+    # Plots are shown interactively unless a directory is given to render them to
+    if args.save_plots is None:
+        return None
+    return os.path.join(args.save_plots, 'dataset_{}_{}.png'.format(args.dataset, name))
+
+
+def save_report(args):
+    if args.report_path is not None:
+        ins.get_recorder().save(args.report_path)
+        print('Saved run report to', args.report_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dataset', type=int, required=True)
+    parser.add_argument('-cache_dir', type=str, default=None)
+    parser.add_argument('-image_scale', type=int, default=1, choices=[1, 2, 4, 8])
+    parser.add_argument('-image_cache_mb', type=int, default=256)
+    parser.add_argument('-ba', action='store_true')
+    parser.add_argument('-tracks', action='store_true')
+    parser.add_argument('-workers', type=int, default=1)
+    parser.add_argument('-seed', type=int, default=None)
+    parser.add_argument('-loop_pairs', type=str, nargs='*', default=None)
+    parser.add_argument('-retrieval_k', type=int, default=None)
+    parser.add_argument('-checkpoint_dir', type=str, default=None)
+    parser.add_argument('-resume_from', type=str, default=None, choices=ck.STAGES)
+    parser.add_argument('-map_path', type=str, default=None)
+    parser.add_argument('-register_images', type=str, nargs='*', default=None)
+    parser.add_argument('-save_plots', type=str, default=None)
+    parser.add_argument('-plot_stages', action='store_true')
+    parser.add_argument('-export_path', type=str, default=None)
+    parser.add_argument('-export_formats', type=str, nargs='+', default=['ply', 'npy'], choices=['ply', 'npy'])
+    parser.add_argument('-outlier_method', type=str, default='percentile', choices=['percentile', 'statistical'])
+    parser.add_argument('-preview_points', type=int, default=None)
+    parser.add_argument('-report_path', type=str, default=None)
+    parser.add_argument('-profile_dir', type=str, default=None)
+    parser.add_argument('-trace_memory', action='store_true')
+    args = parser.parse_args()
+    if args.resume_from is not None and args.checkpoint_dir is None:
+        parser.error('-resume_from requires -checkpoint_dir')
+    if args.register_images and args.map_path is None:
+        parser.error('-register_images requires -map_path')
+    print('Dataset:', args.dataset)
+    if args.report_path is not None or args.profile_dir is not None:
+        ins.set_recorder(ins.Recorder(profile_dir=args.profile_dir, trace_memory=args.trace_memory))
+
+    print('\n\n\n### Initializing ###\n')
+    data_set = args.dataset-1
+    K, img_names, init_pair, pixel_threshold = dataset.get_dataset_info(data_set)
+    K_inv = LA.inv(K)
+    if args.register_images:
+        print('\n\n\n### Loading reconstruction map ###\n')
+        rmap = rm.ReconstructionMap.load(args.map_path)
+        n_map_imgs = len(rmap.img_names)
+        all_img_names = rmap.img_names + args.register_images
+        imgs = im.ImageSource(all_img_names, grayscale=True, scale=args.image_scale, max_bytes=args.image_cache_mb*2**20)
+        features = ft.FeatureStore(all_img_names, cache_dir=args.cache_dir, verbose=True, images=imgs)
+
+        for img_idx in range(n_map_imgs, len(features)):
+            pl.register_image_incrementally(rmap, features, img_idx, K, 3*pixel_threshold)
+        rmap.save(args.map_path)
+        print('Saved reconstruction map with', rmap.n_cams, 'cameras and', rmap.n_pts, 'points to', args.map_path)
+        save_report(args)
+        return
+
+    imgs = im.ImageSource(img_names, grayscale=True, scale=args.image_scale, max_bytes=args.image_cache_mb*2**20)
+    features = ft.FeatureStore(img_names, cache_dir=args.cache_dir, verbose=True, images=imgs)
+    n_imgs = len(features)
+    n_camera_pairs = n_imgs-1
+    loop_pairs = [tuple(int(i) for i in pair.split(',')) for pair in args.loop_pairs] if args.loop_pairs else None
+    if args.retrieval_k is not None:
+        loop_pairs = (loop_pairs or []) + pl.compute_retrieval_pairs(features, args.retrieval_k, seed=args.seed)
+    checkpoints = ck.StageCheckpoints(args.checkpoint_dir, args.dataset, resume_from=args.resume_from)
+    # Each stage is keyed by the settings that feed it, the checkpoints chain in the hash of the upstream stage
+    input_params = {'img_names': img_names, 'init_pair': init_pair, 'pixel_threshold': pixel_threshold, 'image_scale': args.image_scale}
+    refinement_params = {'sparse': True, 'analytic_jac': True}
+    ba_params = {'max_its': 50}
+    stage_params = {
+        'rotation_averaging': dict(input_params, seed=args.seed, loop_pairs=loop_pairs, n_workers=args.workers, ransac=pl.RA_RANSAC_PARAMS),
+        'initial_3D_points': dict(input_params, ransac=pl.INIT_RANSAC_PARAMS),
+        'translation_registration': dict(input_params, ransac=pl.TR_RANSAC_PARAMS),
+        'refinement': refinement_params,
+        'bundle_adjustment': ba_params,
+    }
+
+    abs_rots, x1_norm_RA, x2_norm_RA, inliers_RA, matches_RA = checkpoints.run('rotation_averaging', stage_params['rotation_averaging'], lambda: pl.compute_rotation_averaging(features, init_pair, K, pixel_threshold, plot=args.plot_stages, n_workers=args.workers, seed=args.seed, loop_pairs=loop_pairs, save_path=plot_path(args, 'rotation_averaging')))
+    x1_init_norm_feasible_inliers, x2_init_norm_feasible_inliers, des1_init_feasible_inliers, des2_init_feasible_inliers, X_init_feasible_inliers, X_init_idx, kp_init_idx_feasible_inliers = checkpoints.run('initial_3D_points', stage_params['initial_3D_points'], lambda: pl.compute_initial_3D_points(features, init_pair, K, 3*pixel_threshold, plot=args.plot_stages, save_path=plot_path(args, 'initial_3D_points')))
+    trans, valid_cameras, x_norm_TR, X_idx_TR, inliers_TR, kp_idx_TR = checkpoints.run('translation_registration', stage_params['translation_registration'], lambda: pl.compute_translation_registration(K, features, init_pair, 3*pixel_threshold, abs_rots, x1_init_norm_feasible_inliers, x2_init_norm_feasible_inliers, des1_init_feasible_inliers, X_init_feasible_inliers, X_init_idx, kp_init_idx_feasible_inliers))
+    abs_rots_opt, trans_opt = checkpoints.run('refinement', stage_params['refinement'], lambda: pl.refine_rotations_and_translations(trans, abs_rots, X_init_feasible_inliers, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR, **refinement_params))
+    cameras = pl.create_cameras(abs_rots, trans)
+    cameras_opt = pl.create_cameras(abs_rots_opt, trans_opt)
+    X_final, valid_idx = pl.triangulate_final_3D_reconstruction(features, K, pixel_threshold, cameras, valid_cameras, inliers_RA, x1_norm_RA, x2_norm_RA, matches_RA=matches_RA, tracks=args.tracks, outlier_method=args.outlier_method)
+    pl.plot_reconstruction(X_final, cameras, valid_idx, 'Final 3D Reconstruction with LM=False', save_path=plot_path(args, 'final_LM_false'), max_pts=args.preview_points)
+    if args.export_path is not None:
+        # The refined reconstruction is streamed to disk and plotted from a memory map of the export
+        with ex.PointCloudWriter(args.export_path, formats=args.export_formats) as writer:
+            _, valid_idx = pl.triangulate_final_3D_reconstruction(features, K, pixel_threshold, cameras_opt, valid_cameras, inliers_RA, x1_norm_RA, x2_norm_RA, matches_RA=matches_RA, tracks=args.tracks, writer=writer, outlier_method=args.outlier_method)
+        X_final_opt = [ex.read_points(writer.point_path(args.export_formats[0]))]
+    else:
+        X_final_opt, valid_idx = pl.triangulate_final_3D_reconstruction(features, K, pixel_threshold, cameras_opt, valid_cameras, inliers_RA, x1_norm_RA, x2_norm_RA, matches_RA=matches_RA, tracks=args.tracks, outlier_method=args.outlier_method)
+    pl.plot_reconstruction(X_final_opt, cameras_opt, valid_idx, 'Final 3D Reconstruction with LM=True', save_path=plot_path(args, 'final_LM_true'), max_pts=args.preview_points)
+
+    if args.ba:
+        cameras_ba, X_ba = checkpoints.run('bundle_adjustment', stage_params['bundle_adjustment'], lambda: pl.compute_bundle_adjustment(trans, abs_rots, X_init_feasible_inliers, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR, init_pair, **ba_params))
+        pl.plot_reconstruction(X_ba, cameras_ba, np.flatnonzero(valid_cameras), '3D Reconstruction with bundle adjustment', multi=False, save_path=plot_path(args, 'ba'), max_pts=args.preview_points)
+
+    if args.map_path is not None:
+        rmap = pl.create_reconstruction_map(img_names, abs_rots_opt, trans_opt, valid_cameras, X_init_feasible_inliers, des1_init_feasible_inliers, X_idx_TR, x_norm_TR, inliers_TR, kp_idx_TR)
+        rmap.save(args.map_path)
+        print('Saved reconstruction map with', rmap.n_cams, 'cameras and', rmap.n_pts, 'points to', args.map_path)
+
+    save_report(args)
+
+
+if __name__ == '__main__':
+    main()
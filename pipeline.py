@@ -1,54 +1,114 @@
+import bundle_adjustment as ba
 import computer_vision as cv
-import matplotlib as mpl
-import matplotlib.image as mpimg
-from matplotlib.pyplot import cm
-import matplotlib.pyplot as plt
-from mpl_toolkits import mplot3d
+from concurrent.futures import ProcessPoolExecutor
+import instrumentation as ins
 from numpy import linalg as LA
 import numpy as np
+import os
+import point_cloud as pc
+import reconstruction_map as rm
+import retrieval as rt
+import tracks as tr
 from scipy import optimize
+from scipy import sparse as sparse_matrix
 from scipy.spatial.transform import Rotation
 
 
-def compute_rotation_averaging(imgs, init_pair, K, pixel_threshold, plot=False):
-    print('\n\n\n### Computing rotation averaging ###\n')
+# Stage settings live at module level so that checkpoints can be keyed by them
+RANSAC_PARAM_NAMES = ('marg', 'min_its', 'max_its', 'scale_its', 'alpha', 'batch_size', 'sprt', 'sampling', 'solver', 'local_optimization')
+# The 5-point solver scores up to 10 candidates per sample, a low floor lets PROSAC and SPRT end the search early
+RA_RANSAC_PARAMS = {'marg': 0.75, 'min_its': 2000, 'max_its': 20000, 'scale_its': 4, 'alpha': 0.99, 'batch_size': 1000, 'sprt': True, 'sampling': 'prosac', 'solver': '5point', 'local_optimization': True}
+# Uniform sampling needs a high floor to find the initial pair reliably, PROSAC finds it within the first draws
+INIT_RANSAC_PARAMS = {'marg': 0.75, 'min_its': 1000, 'max_its': 40000, 'scale_its': 3, 'alpha': 0.99, 'batch_size': 1000, 'sprt': True, 'sampling': 'prosac', 'solver': '5point', 'local_optimization': True, 'percentile': 90}
+TR_RANSAC_PARAMS = {'marg': 0.75, 'min_its': 15000, 'max_its': 20000, 'scale_its': 1, 'alpha': 0.99, 'batch_size': 1000, 'sprt': True, 'local_optimization': True}
+
+
+def estimate_relative_pose(pair, pts1, des1, pts2, des2, K, pixel_threshold, ransac_params, seed, index2=None):
+    print('\nCamera pair:', pair[0]+1, '-', pair[1]+1)
+    np.random.seed(seed)
 
     K_inv = LA.inv(K)
-    n_imgs = imgs.shape[0]
+    marg, min_its, max_its, scale_its, alpha, batch_size, sprt, sampling, solver, local_optimization = ransac_params
+    P1 = cv.get_canonical_camera()
+
+    idx1, idx2, ratio = cv.match_sift_indices(des1, des2, marg, flann=True, index2=index2, verbose=True)
+    x1_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts1[:,idx1], multi=True))
+    x2_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts2[:,idx2], multi=True))
+
+    E, inliers = cv.estimate_E_robust(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, pixel_threshold, essential_matrix=True, homography=True, verbose=True, batch_size=batch_size, sprt=sprt, sampling=sampling, quality=ratio, solver=solver, local_optimization=local_optimization)
+    if E is None:
+        # Without a relative pose the pair gets the identity rotation and no inliers, so it has no weight in global averaging
+        print('No relative pose found from', x1_norm.shape[1], 'matches')
+        return x1_norm, x2_norm, inliers, P1, np.zeros((4, 0)), np.stack([idx1, idx2])
+
+    x1_norm_inliers = x1_norm[:,inliers]
+    x2_norm_inliers = x2_norm[:,inliers]
+
+    P2_arr = cv.extract_P_from_E(E)
+    X_arr = cv.compute_triangulated_X_from_extracted_P2_solutions(P1, P2_arr, x1_norm_inliers, x2_norm_inliers)
+    P2, X = cv.extract_valid_camera_and_points(P1, P2_arr, X_arr, verbose=True)
+
+    return x1_norm, x2_norm, inliers, P2, X, np.stack([idx1, idx2])
+
+
+def estimate_relative_poses(features, pairs, K, pixel_threshold, ransac_params, n_workers=1, seed=None):
+    # One seed per pair, so the results do not depend on the number of workers
+    seeds = [s.generate_state(1)[0] for s in np.random.SeedSequence(seed).spawn(len(pairs))]
+    tasks = [(pair, *features[pair[0]], *features[pair[1]], K, pixel_threshold, ransac_params, pair_seed) for pair, pair_seed in zip(pairs, seeds)]
+
+    if n_workers > 1:
+        # FLANN indices cannot be pickled, so each worker indexes its own pairs
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            if ins.get_recorder() is None:
+                results = list(executor.map(estimate_relative_pose, *zip(*tasks)))
+            else:
+                # Workers record into their own recorders, which are merged into the stage of the parent
+                results = []
+                for result, kernels, worker_peak_rss_mb in executor.map(ins.run_recorded, [estimate_relative_pose]*len(tasks), *zip(*tasks)):
+                    ins.merge_worker_kernels(kernels, worker_peak_rss_mb)
+                    results.append(result)
+    else:
+        results = [estimate_relative_pose(*task, index2=features.index(pair[1])) for task, pair in zip(tasks, pairs)]
+    return results
+
+
+def compute_retrieval_pairs(features, k, seed=None):
+    print('\n\n\n### Computing retrieval pairs ###\n')
+
+    n_words = 256
+    n_samples = 50000
+    pairs = rt.propose_pairs(features, k, n_words=n_words, n_samples=n_samples, seed=seed, verbose=True)
+    print('Proposed camera pairs:', pairs)
+    return pairs
+
+
+@ins.stage('rotation_averaging')
+def compute_rotation_averaging(features, init_pair, K, pixel_threshold, plot=False, n_workers=1, seed=None, loop_pairs=None, save_path=None):
+    print('\n\n\n### Computing rotation averaging ###\n')
+
+    n_imgs = len(features)
     n_camera_pairs = n_imgs-1
 
-    marg = 0.75
-    min_its = 15000
-    max_its = 20000
-    scale_its = 4
-    alpha = 0.99
+    ransac_params = tuple(RA_RANSAC_PARAMS[k] for k in RANSAC_PARAM_NAMES)
     P1 = cv.get_canonical_camera()
     rel_cameras = [P1]
 
     x1_norm_RA = []
     x2_norm_RA = []
     inliers_RA = []
+    matches_RA = []
 
-    for i in range(n_camera_pairs):    
-        print('\nCamera pair:', i+1, '/', n_camera_pairs)
+    pairs = [(i, i+1) for i in range(n_camera_pairs)]
+    if loop_pairs is not None:
+        loop_pairs = [tuple(sorted(pair)) for pair in loop_pairs]
+        pairs += sorted(set(pair for pair in loop_pairs if pair[1] - pair[0] > 1))
+    results = estimate_relative_poses(features, pairs, K, pixel_threshold, ransac_params, n_workers=n_workers, seed=seed)
 
-        img1 = imgs[i]
-        img2 = imgs[i+1]
-        x1, x2, _, _ = cv.compute_sift_points(img1, img2, marg, flann=True, verbose=True)
-        x1_norm = cv.dehomogenize(K_inv @ x1)
-        x2_norm = cv.dehomogenize(K_inv @ x2)
+    for i, (x1_norm, x2_norm, inliers, P2, X, matches) in enumerate(results[:n_camera_pairs]):
         x1_norm_RA.append(x1_norm)
         x2_norm_RA.append(x2_norm)
-
-        E, inliers = cv.estimate_E_robust(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, pixel_threshold, essential_matrix=True, homography=True, verbose=True)
         inliers_RA.append(inliers)
-
-        x1_norm_inliers = x1_norm[:,inliers]
-        x2_norm_inliers = x2_norm[:,inliers]
-
-        P2_arr = cv.extract_P_from_E(E)
-        X_arr = cv.compute_triangulated_X_from_extracted_P2_solutions(P1, P2_arr, x1_norm_inliers, x2_norm_inliers)
-        P2, X = cv.extract_valid_camera_and_points(P1, P2_arr, X_arr, verbose=True)
+        matches_RA.append(matches)
         rel_cameras.append(P2)
 
         if plot:
@@ -56,42 +116,56 @@ def compute_rotation_averaging(imgs, init_pair, K, pixel_threshold, plot=False):
             feasable_pts = cv.compute_feasible_points(P1, P2, X, percentile)
             P_arr = np.array([P1, P2])
             C_arr, axis_arr = cv.compute_camera_center_and_normalized_principal_axis(P_arr, multi=True)
-            cv.plot_cameras_and_3D_points(X[:,feasable_pts], C_arr, axis_arr, s=1, title=None, valid_idx=[0,1], multi=False)
-
-    rel_cameras = np.array(rel_cameras)
-    rel_rots = rel_cameras[:,:,:-1]
-    abs_rots = cv.compute_absolute_rotations(rel_rots, init_pair[0], verbose=True)
+            pair_path = None
+            if save_path is not None:
+                # Every camera pair is rendered to its own file
+                root, ext = os.path.splitext(save_path)
+                pair_path = '{}_pair_{}{}'.format(root, i+1, ext)
+            cv.plot_cameras_and_3D_points(X[:,feasable_pts], C_arr, axis_arr, s=1, title=None, valid_idx=[0,1], multi=False, save_path=pair_path)
+
+    if len(pairs) > n_camera_pairs:
+        print('\nGlobal rotation averaging over', len(pairs), 'camera pairs')
+        rel_rots = np.array([result[3][:,:-1] for result in results])
+        weights = np.array([np.sum(result[2]) for result in results])
+        abs_rots = cv.compute_global_rotations(n_imgs, pairs, rel_rots, weights, init_pair[0], verbose=True)
+    else:
+        rel_cameras = np.array(rel_cameras)
+        rel_rots = rel_cameras[:,:,:-1]
+        abs_rots = cv.compute_absolute_rotations(rel_rots, init_pair[0], verbose=True)
     
-    return abs_rots, x1_norm_RA, x2_norm_RA, inliers_RA 
+    return abs_rots, x1_norm_RA, x2_norm_RA, inliers_RA, matches_RA
 
 
-def compute_initial_3D_points(imgs, init_pair, K, pixel_threshold, plot=False):
+@ins.stage('initial_3D_points')
+def compute_initial_3D_points(features, init_pair, K, pixel_threshold, plot=False, save_path=None):
     print('\n\n\n### Computing initial 3D-points ###\n')
 
     K_inv = LA.inv(K)
-    min_its = 40000
-    max_its = 40000
-    scale_its = 3
-    alpha = 0.99
-    marg = 0.75
+    marg, min_its, max_its, scale_its, alpha, batch_size, sprt, sampling, solver, local_optimization = (INIT_RANSAC_PARAMS[k] for k in RANSAC_PARAM_NAMES)
 
-    x1_init, x2_init, des1_init, des2_init = cv.compute_sift_points(imgs[init_pair[0]], imgs[init_pair[1]], marg, flann=True, verbose=True)
-    x1_init_norm = cv.dehomogenize(K_inv @ x1_init)
-    x2_init_norm = cv.dehomogenize(K_inv @ x2_init)
+    pts1, des1 = features[init_pair[0]]
+    pts2, des2 = features[init_pair[1]]
+    idx1, idx2, ratio = cv.match_sift_indices(des1, des2, marg, flann=True, index2=features.index(init_pair[1]), verbose=True)
+    x1_init_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts1[:,idx1], multi=True))
+    x2_init_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts2[:,idx2], multi=True))
+    des1_init = des1[idx1]
+    des2_init = des2[idx2]
+    kp_init_idx = np.stack([idx1, idx2])
 
-    E, inliers = cv.estimate_E_robust(K, x1_init_norm, x2_init_norm, min_its, max_its, scale_its, alpha, pixel_threshold, essential_matrix=True, homography=True, verbose=True)
+    E, inliers = cv.estimate_E_robust(K, x1_init_norm, x2_init_norm, min_its, max_its, scale_its, alpha, pixel_threshold, essential_matrix=True, homography=True, verbose=True, batch_size=batch_size, sprt=sprt, sampling=sampling, quality=ratio, solver=solver, local_optimization=local_optimization)
 
     x1_init_norm_inliers = x1_init_norm[:,inliers]
     x2_init_norm_inliers = x2_init_norm[:,inliers]
     des1_init_inliers = des1_init[inliers]
     des2_init_inliers = des2_init[inliers]
+    kp_init_idx_inliers = kp_init_idx[:,inliers]
 
     P1 = cv.get_canonical_camera()
     P2_arr = cv.extract_P_from_E(E)
     X_arr = cv.compute_triangulated_X_from_extracted_P2_solutions(P1, P2_arr, x1_init_norm_inliers, x2_init_norm_inliers)
     P2, X_init_inliers = cv.extract_valid_camera_and_points(P1, P2_arr, X_arr, verbose=True)
 
-    percentile = 90
+    percentile = INIT_RANSAC_PARAMS['percentile']
     feasible_pts = cv.compute_feasible_points(P1, P2, X_init_inliers, percentile)
 
     x1_init_norm_feasible_inliers = x1_init_norm_inliers[:,feasible_pts]
@@ -100,131 +174,159 @@ def compute_initial_3D_points(imgs, init_pair, K, pixel_threshold, plot=False):
     des2_init_feasible_inliers = des2_init_inliers[feasible_pts]
     X_init_feasible_inliers = X_init_inliers[:,feasible_pts]
     X_init_idx = np.ones(X_init_feasible_inliers.shape[1], dtype=bool)
+    # Keypoint ids of the initial pair, carried along so every map observation knows its keypoint
+    kp_init_idx_feasible_inliers = kp_init_idx_inliers[:,feasible_pts]
 
     if plot:
-        cv.plot_3D_points(X_init_feasible_inliers)
+        cv.plot_3D_points(X_init_feasible_inliers, save_path=save_path)
     
-    return x1_init_norm_feasible_inliers, x2_init_norm_feasible_inliers, des1_init_feasible_inliers, des2_init_feasible_inliers, X_init_feasible_inliers, X_init_idx
+    return x1_init_norm_feasible_inliers, x2_init_norm_feasible_inliers, des1_init_feasible_inliers, des2_init_feasible_inliers, X_init_feasible_inliers, X_init_idx, kp_init_idx_feasible_inliers
 
 
-def compute_translation_registration(K, imgs, init_pair, pixel_threshold, abs_rots, x1_init_norm_feasible_inliers, x2_init_norm_feasible_inliers, des1_init_feasible_inliers, X_init_feasible_inliers, X_init_idx):
+@ins.stage('translation_registration')
+def compute_translation_registration(K, features, init_pair, pixel_threshold, abs_rots, x1_init_norm_feasible_inliers, x2_init_norm_feasible_inliers, des1_init_feasible_inliers, X_init_feasible_inliers, X_init_idx, kp_init_idx_feasible_inliers):
     print('\n\n\n### Computing translation registration ###\n')
 
     K_inv = LA.inv(K)
-    marg = 0.75
-    min_its = 15000
-    max_its = 20000
-    scale_its = 1
-    alpha = 0.99
+    marg, min_its, max_its, scale_its, alpha, batch_size, sprt, local_optimization = (TR_RANSAC_PARAMS[k] for k in ('marg', 'min_its', 'max_its', 'scale_its', 'alpha', 'batch_size', 'sprt', 'local_optimization'))
 
     trans = []
     x_norm_TR = []
     X_idx_TR = []
+    kp_idx_TR = []
     inliers_TR = []
 
-    n_imgs = imgs.shape[0]
+    n_imgs = len(features)
     valid_cameras = np.ones(n_imgs, dtype=bool)
 
     for i in range(n_imgs):
         print('\nImage:', i+1, '/', n_imgs)
 
         if (i != init_pair[1]) and (i != init_pair[0]):
-            img2 = imgs[i]            
-            _, x2, X_idx = cv.compute_sift_points_TR(x1_init_norm_feasible_inliers, des1_init_feasible_inliers, img2, marg, flann=True, verbose=True)
-            x_norm = cv.dehomogenize(K_inv @ x2)
+            # The descriptors of the 3D points are the queries, the index over the new image is cached by the feature store
+            pts2, des2 = features[i]
+            X_idx, kp_idx, ratio = cv.match_sift_indices(des1_init_feasible_inliers, des2, marg, flann=True, index2=features.index(i), verbose=True)
+            x_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts2[:,kp_idx], multi=True))
         elif i == init_pair[0]:
             x_norm = x1_init_norm_feasible_inliers
             X_idx = X_init_idx
+            kp_idx = kp_init_idx_feasible_inliers[0]
+            ratio = None
         elif i == init_pair[1]:
             x_norm = x2_init_norm_feasible_inliers
             X_idx = X_init_idx
+            kp_idx = kp_init_idx_feasible_inliers[1]
+            ratio = None
 
         X = X_init_feasible_inliers[:,X_idx]        
         R = abs_rots[i]
 
-        T, inliers = cv.estimate_T_robust(K, R, X[:-1], x_norm, min_its, max_its, scale_its, alpha, pixel_threshold, verbose=True)
+        # The initial pair has no match scores, its points are inliers already
+        sampling = 'prosac' if ratio is not None else 'uniform'
+        T, inliers = cv.estimate_T_robust(K, R, X[:-1], x_norm, min_its, max_its, scale_its, alpha, pixel_threshold, verbose=True, batch_size=batch_size, sprt=sprt, sampling=sampling, quality=ratio, local_optimization=local_optimization)
         
         if np.isnan(T[0]):
             valid_cameras[i] = False
 
         x_norm_TR.append(x_norm)
         X_idx_TR.append(X_idx)
+        kp_idx_TR.append(kp_idx)
         trans.append(T)
         inliers_TR.append(inliers)
         
     trans = np.array(trans)
-    return trans, valid_cameras, x_norm_TR, X_idx_TR, inliers_TR
+    return trans, valid_cameras, x_norm_TR, X_idx_TR, inliers_TR, kp_idx_TR
 
 
-def refine_rotations_and_translations(trans, abs_rots, X_init_feasible_inliers, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR):
+@ins.stage('refinement')
+def refine_rotations_and_translations(trans, abs_rots, X_init_feasible_inliers, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR, sparse=True, analytic_jac=True):
     print('\n\n\n### Refining translations and rotations ###\n')
 
-    def fun(params, n_valid_cams, xs_norm, X_init, X_idx_TR, inliers_TR, valid_cameras):
-
+    def project(params, n_valid_cams, X_obs, cam_idx):
         trans = params[:n_valid_cams * 3].reshape((n_valid_cams, 3))
         q_arr = params[n_valid_cams * 3:].reshape((n_valid_cams, 4))
-        rots = []
+        rots = cv.compute_rotations_from_quaternions(q_arr)
+
+        Y = np.einsum('mij,jm->im', rots[cam_idx], X_obs) + trans[cam_idx].T
+        return Y, q_arr
 
-        for i in range(n_valid_cams):
-            R = Rotation.from_quat(q_arr[i] / LA.norm(q_arr[i])).as_matrix()
-            U, _, VT = LA.svd(R, full_matrices=False)
-            R = U @ VT
-            rots.append(R)
+    def fun(params, n_valid_cams, xs_norm, X_obs, cam_idx):
+        Y, _ = project(params, n_valid_cams, X_obs, cam_idx)
+        xs_proj = Y[:2] / Y[2]
+        return (xs_proj - xs_norm).ravel()
 
-        xs_proj = []
-        t = 0
-        for i in range(len(valid_cameras)):
+    def jac(params, n_valid_cams, xs_norm, X_obs, cam_idx):
+        Y, q_arr = project(params, n_valid_cams, X_obs, cam_idx)
+        z_inv = 1 / Y[2]
+        xs_proj = Y[:2] * z_inv
 
-            if valid_cameras[i]:
+        # Jacobian of the projection w.r.t. the camera coordinates, shape (m, 2, 3)
+        n_obs = X_obs.shape[1]
+        dx_dY = np.zeros((n_obs, 2, 3))
+        dx_dY[:,0,0] = z_inv
+        dx_dY[:,1,1] = z_inv
+        dx_dY[:,:,2] = -(xs_proj * z_inv).T
 
-                X_idx = X_idx_TR[i]
-                inliers_T = inliers_TR[i]
+        dR_dq = cv.compute_rotation_quaternion_jacobians(q_arr)
+        dY_dq = np.einsum('mijk,jm->mik', dR_dq[cam_idx], X_obs)
+        dx_dq = dx_dY @ dY_dq
 
-                R = rots[t] 
-                X = X_init[:,X_idx][:,inliers_T]
-                T = trans[t]
-                t += 1
+        values = np.concatenate((dx_dY, dx_dq), 2) # (m, 2, 7)
+        return values.transpose(1,0,2).reshape(2*n_obs, 7)
 
-                x_proj = cv.dehomogenize(R @ X + T[:,None])
-                xs_proj.append(x_proj)
-        xs_proj = np.concatenate(xs_proj, 1)
+    def jac_sparse(params, n_valid_cams, xs_norm, X_obs, cam_idx):
+        values = jac(params, n_valid_cams, xs_norm, X_obs, cam_idx)
+        return sparse_matrix.csr_matrix((values.ravel(), (jac_rows.ravel(), jac_cols.ravel())), shape=(values.shape[0], 7*n_valid_cams))
 
-        return (xs_proj - xs_norm).ravel()
+    def jac_dense(params, n_valid_cams, xs_norm, X_obs, cam_idx):
+        return jac_sparse(params, n_valid_cams, xs_norm, X_obs, cam_idx).toarray()
 
 
     xs_norm = []
+    X_obs = []
+    cam_idx = []
     n_trans = trans.shape[0]
+    X_init = X_init_feasible_inliers[:-1]
 
+    t = 0
     for i in range(n_trans):
         if valid_cameras[i]:
             x_norm = x_norm_TR[i]
             inliers_T = inliers_TR[i]
-            xs_norm.append(x_norm[:,inliers_T])
+            xs_norm.append(x_norm[:2,inliers_T])
+            X_obs.append(X_init[:,X_idx_TR[i]][:,inliers_T])
+            cam_idx.append(np.full(np.sum(inliers_T), t))
+            t += 1
     xs_norm = np.concatenate(xs_norm, 1)
+    X_obs = np.concatenate(X_obs, 1)
+    cam_idx = np.concatenate(cam_idx, 0)
 
     n_valid_cams = np.sum(valid_cameras)
+    n_obs = cam_idx.shape[0]
 
-    q_arr = []
-    for i in range(n_trans): # n_imgs
-        if valid_cameras[i]:
-            R = abs_rots[i]
-            q = Rotation.from_matrix(R).as_quat()
-            q_arr.append(q)
-    q_arr = np.concatenate(q_arr, 0)
+    # Each residual only depends on the 3 translation and 4 quaternion parameters of its camera
+    cam_cols = np.concatenate((3*cam_idx[:,None] + np.arange(3), 3*n_valid_cams + 4*cam_idx[:,None] + np.arange(4)), 1)
+    jac_cols = np.tile(cam_cols, (2, 1))
+    jac_rows = np.repeat(np.arange(2*n_obs)[:,None], 7, 1)
 
+    q_arr = Rotation.from_matrix(abs_rots[valid_cameras]).as_quat().ravel()
     x0 = np.concatenate((trans[valid_cameras].ravel(), q_arr), 0)
-    res = optimize.least_squares(fun, x0, method='lm', args=(n_valid_cams, xs_norm, X_init_feasible_inliers[:-1], X_idx_TR, inliers_TR, valid_cameras))
+    args = (n_valid_cams, xs_norm, X_obs, cam_idx)
+
+    if sparse and analytic_jac:
+        res = optimize.least_squares(fun, x0, jac=jac_sparse, method='trf', tr_solver='lsmr', args=args)
+    elif sparse:
+        jac_sparsity = sparse_matrix.csr_matrix((np.ones(jac_rows.size), (jac_rows.ravel(), jac_cols.ravel())), shape=(2*n_obs, 7*n_valid_cams))
+        res = optimize.least_squares(fun, x0, jac_sparsity=jac_sparsity, method='trf', tr_solver='lsmr', args=args)
+    elif analytic_jac:
+        res = optimize.least_squares(fun, x0, jac=jac_dense, method='lm', args=args)
+    else:
+        res = optimize.least_squares(fun, x0, method='lm', args=args)
+    print('Refinement cost:', res.cost, 'No. function evaluations:', res.nfev)
 
     trans_opt_valid = res.x[:n_valid_cams * 3].reshape((n_valid_cams, 3))
     q_opt_valid = res.x[n_valid_cams * 3:].reshape((n_valid_cams, 4))
-
-    abs_rots_opt_valid = []
-    for i in range(n_valid_cams):
-        R = Rotation.from_quat(q_opt_valid[i] / LA.norm(q_opt_valid[i])).as_matrix()
-        U, _, VT = LA.svd(R, full_matrices=False)
-        R = U @ VT
-        abs_rots_opt_valid.append(R)
-    abs_rots_opt_valid = np.array(abs_rots_opt_valid)
+    abs_rots_opt_valid = cv.compute_rotations_from_quaternions(q_opt_valid)
 
     trans_opt = []
     abs_rots_opt = []
@@ -242,6 +344,157 @@ def refine_rotations_and_translations(trans, abs_rots, X_init_feasible_inliers,
     return abs_rots_opt, trans_opt
 
 
+@ins.stage('bundle_adjustment')
+def compute_bundle_adjustment(trans, abs_rots, X_init_feasible_inliers, valid_cameras, X_idx_TR, x_norm_TR, inliers_TR, init_pair, max_its=50):
+    print('\n\n\n### Computing bundle adjustment ###\n')
+
+    n_pts = X_init_feasible_inliers.shape[1]
+    valid_idx = np.flatnonzero(valid_cameras)
+    cam_idx, pt_idx, x_obs, _ = collect_observations(valid_idx, n_pts, X_idx_TR, x_norm_TR, inliers_TR)
+
+    # Only points seen in at least two views constrain the structure
+    n_views = np.bincount(pt_idx, minlength=n_pts)
+    observed_pts = n_views >= 2
+    obs_filter = observed_pts[pt_idx]
+    pt_map = np.cumsum(observed_pts) - 1
+    cam_idx = cam_idx[obs_filter]
+    pt_idx = pt_map[pt_idx[obs_filter]]
+    x_obs = x_obs[:,obs_filter]
+
+    fixed_cams = valid_idx == init_pair[0]
+    rots = np.array([abs_rots[i] for i in valid_idx])
+    X = X_init_feasible_inliers[:-1,observed_pts]
+
+    rots_ba, trans_ba, X_ba = ba.bundle_adjust(rots, trans[valid_idx], X, cam_idx, pt_idx, x_obs, fixed_cams=fixed_cams, max_its=max_its, verbose=True)
+
+    abs_rots_ba = np.array(abs_rots, dtype=float)
+    trans_ba_all = np.array(trans, dtype=float)
+    abs_rots_ba[valid_idx] = rots_ba
+    trans_ba_all[valid_idx] = trans_ba
+
+    cameras_ba = create_cameras(abs_rots_ba, trans_ba_all)
+    X_ba = cv.homogenize(X_ba, multi=True)
+    return cameras_ba, X_ba
+
+
+def collect_observations(valid_idx, n_pts, X_idx_TR, x_norm_TR, inliers_TR, kp_idx_TR=None):
+    # The translation inliers of every valid camera are its observations, cameras are numbered among the valid ones
+    pt_ids = np.arange(n_pts)
+    cam_idx = []
+    pt_idx = []
+    x_obs = []
+    kp_obs = []
+
+    for t, i in enumerate(valid_idx):
+        inliers_T = inliers_TR[i]
+        pt_idx.append(pt_ids[X_idx_TR[i]][inliers_T])
+        x_obs.append(x_norm_TR[i][:2,inliers_T])
+        cam_idx.append(np.full(np.sum(inliers_T), t))
+        if kp_idx_TR is not None:
+            kp_obs.append(kp_idx_TR[i][inliers_T])
+
+    kp_obs = np.concatenate(kp_obs, 0) if kp_idx_TR is not None else None
+    return np.concatenate(cam_idx, 0), np.concatenate(pt_idx, 0), np.concatenate(x_obs, 1), kp_obs
+
+
+def create_reconstruction_map(img_names, abs_rots, trans, valid_cameras, X_init_feasible_inliers, des1_init_feasible_inliers, X_idx_TR, x_norm_TR, inliers_TR, kp_idx_TR):
+    valid_idx = np.flatnonzero(valid_cameras)
+    obs_cam, obs_pt, obs_x, obs_kp = collect_observations(valid_idx, X_init_feasible_inliers.shape[1], X_idx_TR, x_norm_TR, inliers_TR, kp_idx_TR)
+
+    abs_rots = np.asarray(abs_rots)
+    trans = np.asarray(trans)
+    X = cv.dehomogenize(X_init_feasible_inliers)[:-1]
+    rmap = rm.ReconstructionMap([img_names[i] for i in valid_idx], abs_rots[valid_idx], trans[valid_idx], X, des1_init_feasible_inliers,
+                                obs_cam, obs_pt, obs_x, obs_kp)
+    return rmap
+
+
+def refine_map_locally(rmap, cam, ref_cam, max_its=10):
+    # The new camera and the points it observes are optimized against every observation of those points,
+    # all other cameras, including the reference camera, are held fixed
+    pt_ids = np.unique(rmap.obs_pt[rmap.obs_cam == cam])
+    obs_filter = np.isin(rmap.obs_pt, pt_ids)
+
+    local_cams = np.unique(np.concatenate((rmap.obs_cam[obs_filter], [ref_cam])))
+    cam_idx = np.searchsorted(local_cams, rmap.obs_cam[obs_filter])
+    pt_idx = np.searchsorted(pt_ids, rmap.obs_pt[obs_filter])
+    fixed_cams = local_cams != cam
+
+    rots, trans, X = ba.bundle_adjust(rmap.rots[local_cams], rmap.trans[local_cams], rmap.X[:,pt_ids], cam_idx, pt_idx, rmap.obs_x[:,obs_filter], fixed_cams=fixed_cams, max_its=max_its, verbose=True)
+    cam_local = np.searchsorted(local_cams, cam)
+    rmap.rots[cam] = rots[cam_local]
+    rmap.trans[cam] = trans[cam_local]
+    rmap.X[:,pt_ids] = X
+
+
+@ins.stage('incremental_registration')
+def register_image_incrementally(rmap, features, img_idx, K, pixel_threshold, refine=True):
+    print('\n\n\n### Registering image incrementally ###\n')
+
+    K_inv = LA.inv(K)
+    marg = 0.75
+    max_its = 10000
+    alpha = 0.99
+    err_threshold = pixel_threshold / K[0,0]
+    img_name = features.img_names[img_idx]
+    print('Image:', img_name)
+
+    pts, des = features[img_idx]
+    x_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts, multi=True))
+
+    # 2D-3D correspondences against every point in the map
+    matches = rmap.index().knnMatch(des, k=2)
+    kp_idx, pt_idx, _ = cv.filter_matches_ratio(*cv.matches_to_arrays(matches), marg)
+    print('Number of 2D-3D matches:', kp_idx.shape[0])
+
+    R, T, inliers = cv.estimate_pose_PnP_robust(K, rmap.X[:,pt_idx], x_norm[:,kp_idx], max_its, alpha, pixel_threshold, verbose=True)
+    if R is None:
+        print('Registration failed for', img_name)
+        return None
+
+    kp_idx = kp_idx[inliers]
+    pt_idx = pt_idx[inliers]
+    cam = rmap.add_camera(img_name, R, T)
+    rmap.add_observations(cam, pt_idx, x_norm[:,kp_idx], kp_idx)
+
+    # Triangulate new points with the registered camera sharing the most points
+    shared_obs = np.bincount(rmap.obs_cam[np.isin(rmap.obs_pt, pt_idx)], minlength=rmap.n_cams)
+    shared_obs[cam] = -1
+    ref_cam = np.argmax(shared_obs)
+    ref_img_idx = features.img_names.index(rmap.img_names[ref_cam])
+    print('Reference camera:', rmap.img_names[ref_cam], 'Shared points:', shared_obs[ref_cam])
+
+    pts_ref, des_ref = features[ref_img_idx]
+    idx_new, idx_ref, _ = cv.match_sift_indices(des, des_ref, marg, index2=features.index(ref_img_idx), verbose=True)
+    used_kp_ref = rmap.obs_kp[rmap.obs_cam == ref_cam]
+    unused = ~np.isin(idx_new, kp_idx) & ~np.isin(idx_ref, used_kp_ref)
+    idx_new = idx_new[unused]
+    idx_ref = idx_ref[unused]
+
+    x_new_norm = x_norm[:,idx_new]
+    x_ref_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts_ref[:,idx_ref], multi=True))
+    P_ref = rmap.cameras()[ref_cam]
+    P_new = rmap.cameras()[cam]
+    X_new = cv.triangulate_3D_point_DLT(P_ref, P_new, x_ref_norm, x_new_norm)
+
+    x_ref_proj = P_ref @ X_new
+    x_new_proj = P_new @ X_new
+    in_front = (x_ref_proj[-1] > 0) & (x_new_proj[-1] > 0)
+    err_ref = cv.compute_point_point_distance(cv.dehomogenize(x_ref_proj), x_ref_norm)
+    err_new = cv.compute_point_point_distance(cv.dehomogenize(x_new_proj), x_new_norm)
+    feasible_pts = in_front & (err_ref < err_threshold) & (err_new < err_threshold)
+    print('New 3D points:', np.sum(feasible_pts), '/', feasible_pts.shape[0])
+
+    new_pt_ids = rmap.add_points(X_new[:-1,feasible_pts], des[idx_new[feasible_pts]])
+    rmap.add_observations(ref_cam, new_pt_ids, x_ref_norm[:,feasible_pts], idx_ref[feasible_pts])
+    rmap.add_observations(cam, new_pt_ids, x_new_norm[:,feasible_pts], idx_new[feasible_pts])
+
+    if refine:
+        refine_map_locally(rmap, cam, ref_cam)
+
+    return cam
+
+
 def create_cameras(abs_rots, trans):
     cameras = []
 
@@ -254,14 +507,22 @@ def create_cameras(abs_rots, trans):
     return cameras
 
 
-def triangulate_final_3D_reconstruction(imgs, K, pixel_threshold, cameras, valid_cameras, inliers_RA, x1_norm_RA, x2_norm_RA, title):
+@ins.stage('final_3D_reconstruction')
+def triangulate_final_3D_reconstruction(features, K, pixel_threshold, cameras, valid_cameras, inliers_RA, x1_norm_RA, x2_norm_RA, matches_RA=None, tracks=False, writer=None, outlier_method='percentile'):
+    if tracks and matches_RA is None:
+        raise ValueError('Triangulating tracks needs the matches of the rotation averaging stage, matches_RA is None')
     print('\n\n\n### Triangulating final 3D-reconstruction ###\n')
 
     K_inv = LA.inv(K)
     marg = 0.75
     alpha = 0.99
+    batch_size = 1000
+    sprt = True
+    local_optimization = True
+    percentile = 90
 
     X_final = []
+    pair_matches = []
     valid_idx = []
     n_valid_cameras = np.sum(valid_cameras)
 
@@ -281,28 +542,92 @@ def triangulate_final_3D_reconstruction(imgs, K, pixel_threshold, cameras, valid
         P2 = cameras[ij]
 
         if i+1 < ij:
-            img1 = imgs[i]
-            img2 = imgs[ij]
-            x1, x2, _, _ = cv.compute_sift_points(img1, img2, marg, flann=True, verbose=True)
-            x1_norm = cv.dehomogenize(K_inv @ x1)
-            x2_norm = cv.dehomogenize(K_inv @ x2)
+            pts1, des1 = features[i]
+            pts2, des2 = features[ij]
+            idx1, idx2, ratio = cv.match_sift_indices(des1, des2, marg, flann=True, index2=features.index(ij), verbose=True)
+            x1_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts1[:,idx1], multi=True))
+            x2_norm = cv.dehomogenize(K_inv @ cv.homogenize(pts2[:,idx2], multi=True))
 
             min_its = 0
             max_its = 10000
             scale_its = 1
-            _, inliers = cv.estimate_E_robust(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, pixel_threshold, essential_matrix=True, homography=True, verbose=True)
+            _, inliers = cv.estimate_E_robust(K, x1_norm, x2_norm, min_its, max_its, scale_its, alpha, pixel_threshold, essential_matrix=True, homography=True, verbose=True, batch_size=batch_size, sprt=sprt, sampling='prosac', quality=ratio, solver='5point', local_optimization=local_optimization)
+            matches = np.stack([idx1, idx2])
         else:
             inliers = inliers_RA[i]
             x1_norm = x1_norm_RA[i]
             x2_norm = x2_norm_RA[i]
+            matches = matches_RA[i] if matches_RA is not None else None
+
+        if tracks:
+            pair_matches.append((i, ij, matches[0,inliers], matches[1,inliers]))
+            continue
         
         x1_norm_inliers = x1_norm[:,inliers]
         x2_norm_inliers = x2_norm[:,inliers]
 
-        percentile = 90
         X_inliers = cv.triangulate_3D_point_DLT(P1, P2, x1_norm_inliers, x2_norm_inliers)
-        feasible_pts = cv.compute_feasible_points(P1, P2, X_inliers, percentile, ransac=False)
-        X_final.append(X_inliers[:,feasible_pts])
+        feasible_pts = cv.compute_feasible_points(P1, P2, X_inliers, percentile, ransac=False, method=outlier_method)
+        # With a writer every pair is streamed to disk instead of being kept in memory
+        if writer is not None:
+            writer.write_points(X_inliers[:,feasible_pts])
+        else:
+            X_final.append(X_inliers[:,feasible_pts])
+
+    if tracks:
+        X_tracks = triangulate_tracks(features, K, pixel_threshold, cameras, pair_matches, percentile, outlier_method=outlier_method)
+        if writer is not None:
+            writer.write_points(X_tracks)
+        else:
+            X_final.append(X_tracks)
+
+    if writer is not None:
+        writer.write_cameras(cameras[valid_idx], valid_idx, K=K, img_names=[features.img_names[i] for i in valid_idx])
+        print('Exported', writer.n_pts, 'points and', valid_idx.shape[0], 'cameras to', writer.path)
+
+    return X_final, valid_idx
+
+
+def plot_reconstruction(X, cameras, valid_idx, title, multi=True, save_path=None, max_pts=None):
+    if max_pts is not None:
+        # Previews are voxel downsampled, each pair keeps its share of the point budget
+        X_list = X if multi else [X]
+        n_pts = sum(X_i.shape[1] for X_i in X_list)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            X_list = [X_i[:-1] / X_i[-1] if X_i.shape[0] == 4 else np.asarray(X_i) for X_i in X_list]
+        X_list = [pc.downsample_to_count(X_i, max(1, max_pts * X_i.shape[1] // max(n_pts, 1))) for X_i in X_list]
+        X = X_list if multi else X_list[0]
 
     C_arr, axis_arr = cv.compute_camera_center_and_normalized_principal_axis(cameras[valid_idx], multi=True)
-    cv.plot_cameras_and_3D_points(X_final, C_arr, axis_arr, s=0.5, title=title, valid_idx=valid_idx, multi=True)
\ No newline at end of file
+    cv.plot_cameras_and_3D_points(X, C_arr, axis_arr, s=0.5, title=title, valid_idx=valid_idx, multi=multi, save_path=save_path)
+
+
+def triangulate_tracks(features, K, pixel_threshold, cameras, pair_matches, percentile, outlier_method='percentile'):
+    print('\nMerging pairwise matches into tracks')
+
+    K_inv = LA.inv(K)
+    err_threshold = pixel_threshold / K[0,0]
+    n_kps = [features[i][0].shape[1] for i in range(len(features))]
+    track_idx, obs_img, obs_kp = tr.build_tracks(pair_matches, n_kps, verbose=True)
+    n_tracks = np.max(track_idx)+1 if track_idx.size > 0 else 0
+
+    x_obs = np.zeros((3, obs_img.shape[0]))
+    for i in np.unique(obs_img):
+        obs = obs_img == i
+        pts, _ = features[i]
+        x_obs[:,obs] = cv.dehomogenize(K_inv @ cv.homogenize(pts[:,obs_kp[obs]], multi=True))
+
+    P_obs = cameras[obs_img]
+    X = cv.triangulate_3D_points_multiview(P_obs, x_obs, track_idx, n_tracks)
+
+    # A track is kept only if it is in front of, and reprojects well into, every camera observing it
+    errors, depths = cv.compute_track_reprojection_errors(P_obs, x_obs, X, track_idx)
+    invalid_obs = ~((depths > 0) & (errors < err_threshold))
+    valid_tracks = np.bincount(track_idx, weights=invalid_obs, minlength=n_tracks) == 0
+    X = X[:,valid_tracks]
+    print('Number of valid tracks:', X.shape[1], '/', n_tracks)
+    if X.shape[1] == 0:
+        return np.zeros((4, 0))
+
+    feasible_pts = cv.compute_feasible_points(None, None, X, percentile, ransac=False, method=outlier_method)
+    return X[:,feasible_pts]
@@ -0,0 +1,97 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def compute_voxel_keys(X, voxel_size):
+    # Integer voxel coordinates are packed into one int64 key per point, so voxels are found with a 1D np.unique,
+    # clouds whose extent does not fit the packing fall back to a unique over the coordinate columns
+    coords = np.floor(X / voxel_size)
+    coords -= np.min(coords, axis=1, keepdims=True)
+    dims = np.max(coords, axis=1) + 1
+    if np.prod(dims) >= 2**62:
+        _, keys = np.unique(coords, axis=1, return_inverse=True)
+        return keys.reshape(-1)
+    coords = coords.astype(np.int64)
+    dims = dims.astype(np.int64)
+    return (coords[0] * dims[1] + coords[1]) * dims[2] + coords[2]
+
+
+def voxel_downsample(X, voxel_size, return_inverse=False):
+    # Replaces the points of every occupied voxel by their centroid, X is (3, n), non-finite points are dropped
+    finite = np.all(np.isfinite(X), axis=0)
+    X_finite = X[:,finite]
+    keys = compute_voxel_keys(X_finite, voxel_size)
+    _, inverse_finite, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    X_down = np.array([np.bincount(inverse_finite, weights=X_finite[i], minlength=counts.shape[0]) for i in range(3)]) / counts
+
+    if return_inverse:
+        inverse = np.full(X.shape[1], -1)
+        inverse[finite] = inverse_finite
+        return X_down, inverse
+    return X_down
+
+
+def downsample_to_count(X, max_pts, growth=1.5):
+    X = X[:,np.all(np.isfinite(X), axis=0)]
+    if X.shape[1] <= max_pts:
+        return X
+    # Points far outside the central box are dropped, so a few distant points cannot blow up the voxel grid
+    lo, hi = np.percentile(X, [5, 95], axis=1)
+    extent = np.maximum(hi - lo, 1e-12)
+    inside = np.all((X >= (lo - extent)[:,None]) & (X <= (hi + extent)[:,None]), axis=0)
+    X = X[:,inside]
+    if X.shape[1] <= max_pts:
+        return X
+
+    # Start from the voxel size that spreads max_pts evenly over the central box
+    voxel_size = (np.prod(extent) / max_pts)**(1/3)
+    X_down = voxel_downsample(X, voxel_size)
+    while X_down.shape[1] > max_pts:
+        voxel_size *= growth
+        X_down = voxel_downsample(X, voxel_size)
+    return X_down
+
+
+class PointCloudIndex:
+
+    def __init__(self, X, leafsize=16):
+        self.X = np.asarray(X, dtype=float)
+        self.tree = cKDTree(self.X.T, leafsize=leafsize)
+
+    @property
+    def n_pts(self):
+        return self.X.shape[1]
+
+    def query_knn(self, Q, k, workers=-1):
+        distances, idx = self.tree.query(np.asarray(Q).T, k=k, workers=workers)
+        return distances, idx
+
+    def query_radius(self, Q, radius, workers=-1):
+        return self.tree.query_ball_point(np.asarray(Q).T, radius, workers=workers)
+
+    def count_radius(self, Q, radius, workers=-1):
+        return self.tree.query_ball_point(np.asarray(Q).T, radius, workers=workers, return_length=True)
+
+    def compute_mean_knn_distances(self, k, workers=-1):
+        # The nearest neighbour of every point is the point itself
+        distances, _ = self.tree.query(self.X.T, k=k+1, workers=workers)
+        return np.mean(distances[:,1:], axis=1)
+
+
+def remove_statistical_outliers(X, k=16, std_ratio=2.0, index=None):
+    # Points whose mean distance to their k nearest neighbours is unusually large lie in sparse regions
+    if X.shape[1] <= k:
+        return np.ones(X.shape[1], dtype=bool)
+    if index is None:
+        index = PointCloudIndex(X)
+    mean_distances = index.compute_mean_knn_distances(k)
+    threshold = np.mean(mean_distances) + std_ratio * np.std(mean_distances)
+    return mean_distances < threshold
+
+
+def remove_radius_outliers(X, radius, min_neighbours, index=None):
+    if index is None:
+        index = PointCloudIndex(X)
+    # Every point counts itself within the radius
+    n_neighbours = index.count_radius(X, radius) - 1
+    return n_neighbours >= min_neighbours
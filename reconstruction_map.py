@@ -0,0 +1,72 @@
+import computer_vision as cv
+import numpy as np
+import os
+
+
+class ReconstructionMap:
+
+    def __init__(self, img_names, rots, trans, X, des, obs_cam, obs_pt, obs_x, obs_kp=None):
+        self.img_names = list(img_names)
+        self.rots = np.asarray(rots, dtype=float).reshape(-1, 3, 3)
+        self.trans = np.asarray(trans, dtype=float).reshape(-1, 3)
+        self.X = np.asarray(X, dtype=float).reshape(3, -1)
+        self.des = np.asarray(des, dtype=np.float32).reshape(-1, 128)
+        self.obs_cam = np.asarray(obs_cam, dtype=int)
+        self.obs_pt = np.asarray(obs_pt, dtype=int)
+        self.obs_x = np.asarray(obs_x, dtype=float).reshape(2, -1)
+        self.obs_kp = np.full(self.obs_cam.shape[0], -1) if obs_kp is None else np.asarray(obs_kp, dtype=int)
+        self._index = None
+
+    @property
+    def n_cams(self):
+        return self.rots.shape[0]
+
+    @property
+    def n_pts(self):
+        return self.X.shape[1]
+
+    def camera_idx(self, img_name):
+        return self.img_names.index(img_name)
+
+    def cameras(self):
+        return np.concatenate((self.rots, self.trans[:,:,None]), 2)
+
+    def index(self):
+        # Rebuilt lazily, only after points have been added
+        if self._index is None:
+            self._index = cv.build_flann_index(self.des)
+        return self._index
+
+    def add_camera(self, img_name, R, T):
+        self.img_names.append(img_name)
+        self.rots = np.concatenate((self.rots, R[None]), 0)
+        self.trans = np.concatenate((self.trans, T[None]), 0)
+        return self.n_cams - 1
+
+    def add_points(self, X, des):
+        pt_ids = np.arange(self.n_pts, self.n_pts + X.shape[1])
+        self.X = np.concatenate((self.X, X), 1)
+        self.des = np.concatenate((self.des, des.astype(np.float32)), 0)
+        self._index = None
+        return pt_ids
+
+    def add_observations(self, cam, pt_ids, x, kp_ids=None):
+        if kp_ids is None:
+            kp_ids = np.full(pt_ids.shape[0], -1)
+        self.obs_cam = np.concatenate((self.obs_cam, np.full(pt_ids.shape[0], cam)))
+        self.obs_pt = np.concatenate((self.obs_pt, pt_ids))
+        self.obs_x = np.concatenate((self.obs_x, x[:2]), 1)
+        self.obs_kp = np.concatenate((self.obs_kp, kp_ids))
+
+    def save(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        np.savez_compressed(path, img_names=np.array(self.img_names), rots=self.rots, trans=self.trans, X=self.X, des=self.des,
+                            obs_cam=self.obs_cam, obs_pt=self.obs_pt, obs_x=self.obs_x, obs_kp=self.obs_kp)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['img_names'].tolist(), data['rots'], data['trans'], data['X'], data['des'],
+                       data['obs_cam'], data['obs_pt'], data['obs_x'], data['obs_kp'])
@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+from scipy import sparse
+
+
+def sample_descriptors(features, n_samples, seed=None):
+    rng = np.random.default_rng(seed)
+    n_per_img = max(1, n_samples // len(features))
+
+    samples = []
+    for i in range(len(features)):
+        _, des = features[i]
+        idx = rng.choice(des.shape[0], min(n_per_img, des.shape[0]), replace=False)
+        samples.append(des[idx])
+    return np.concatenate(samples, 0).astype(np.float32)
+
+
+def train_vocabulary(features, n_words=256, n_samples=50000, n_its=20, seed=None):
+    des = sample_descriptors(features, n_samples, seed=seed)
+    n_words = min(n_words, des.shape[0])
+
+    if seed is not None:
+        cv2.setRNGSeed(seed)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, n_its, 1e-3)
+    _, _, vocabulary = cv2.kmeans(des, n_words, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+    return vocabulary
+
+
+def assign_words(des, vocabulary, chunk_size=4096):
+    vocabulary_norm2 = np.sum(vocabulary**2, axis=1)
+    words = np.empty(des.shape[0], dtype=int)
+
+    for start in range(0, des.shape[0], chunk_size):
+        chunk = des[start:start+chunk_size]
+        distances = vocabulary_norm2[None,:] - 2 * chunk @ vocabulary.T
+        words[start:start+chunk_size] = np.argmin(distances, axis=1)
+    return words
+
+
+class ImageRetrieval:
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.n_words = vocabulary.shape[0]
+        self.image_vectors = None
+        self.inverted_index = None
+
+    def build(self, features):
+        n_imgs = len(features)
+        counts = np.zeros((n_imgs, self.n_words))
+        for i in range(n_imgs):
+            _, des = features[i]
+            counts[i] = np.bincount(assign_words(des, self.vocabulary), minlength=self.n_words)
+
+        # tf-idf weighting with L2-normalized image vectors, the idf is smoothed so that words occurring in every
+        # image, which is common for small vocabularies, keep a nonzero weight
+        n_containing = np.sum(counts > 0, axis=0)
+        self.idf = np.log((1 + n_imgs) / (1 + n_containing)) + 1
+        tf = counts / np.maximum(np.sum(counts, axis=1, keepdims=True), 1)
+        vectors = tf * self.idf
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        self.image_vectors = sparse.csr_matrix(vectors)
+        # Row w of the inverted index holds the posting list of images containing word w
+        self.inverted_index = self.image_vectors.T.tocsr()
+        return self
+
+    def query(self, i, k):
+        scores = (self.image_vectors[i] @ self.inverted_index).toarray().ravel()
+        scores[i] = -np.inf
+        k = min(k, scores.shape[0]-1)
+        neighbours = np.argsort(-scores)[:k]
+        # Images sharing no weighted words with image i are not neighbours
+        neighbours = neighbours[scores[neighbours] > 0]
+        return neighbours, scores[neighbours]
+
+
+def propose_pairs(features, k, n_words=256, n_samples=50000, seed=None, verbose=False):
+    vocabulary = train_vocabulary(features, n_words=n_words, n_samples=n_samples, seed=seed)
+    retrieval = ImageRetrieval(vocabulary).build(features)
+
+    pairs = set()
+    for i in range(len(features)):
+        neighbours, scores = retrieval.query(i, k)
+        if verbose:
+            print('Image:', i, 'Neighbours:', neighbours, 'Scores:', np.round(scores, 3))
+        for j in neighbours:
+            pairs.add((int(min(i, j)), int(max(i, j))))
+    return sorted(pairs)
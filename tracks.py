@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class UnionFind:
+
+    def __init__(self, node_imgs):
+        n = len(node_imgs)
+        self.parent = list(range(n))
+        self.size = [1] * n
+        # Images observed by each set, to refuse merges that would put two keypoints of one image in a track
+        self.imgs = [{img} for img in node_imgs]
+        self.n_conflicts = 0
+
+    def find(self, a):
+        parent = self.parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return True
+        if not self.imgs[a].isdisjoint(self.imgs[b]):
+            self.n_conflicts += 1
+            return False
+
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        self.imgs[a] |= self.imgs[b]
+        self.imgs[b] = None
+        return True
+
+    def roots(self):
+        return np.array([self.find(a) for a in range(len(self.parent))])
+
+
+def build_tracks(pair_matches, n_kps, min_len=2, verbose=False):
+    # Nodes are (image, keypoint) ids flattened with per-image offsets
+    offsets = np.concatenate(([0], np.cumsum(n_kps)[:-1]))
+    edges = [np.stack([offsets[i] + idx_i, offsets[j] + idx_j]) for i, j, idx_i, idx_j in pair_matches]
+    edges = np.concatenate(edges, 1) if edges else np.zeros((2,0), dtype=int)
+
+    # Only keypoints that take part in a match become union-find nodes
+    nodes, edges = np.unique(edges, return_inverse=True)
+    edges = edges.reshape(2, -1)
+    node_imgs = np.searchsorted(offsets, nodes, side='right') - 1
+    node_kps = nodes - offsets[node_imgs]
+
+    # Earlier pairs win conflicts, so consecutive pairs should be passed first
+    uf = UnionFind(node_imgs.tolist())
+    for a, b in edges.T.tolist():
+        uf.union(a, b)
+
+    roots = uf.roots()
+    _, track_idx, track_len = np.unique(roots, return_inverse=True, return_counts=True)
+    valid_obs = track_len[track_idx] >= min_len
+    _, track_idx = np.unique(track_idx[valid_obs], return_inverse=True)
+    obs_img = node_imgs[valid_obs]
+    obs_kp = node_kps[valid_obs]
+
+    if verbose:
+        n_tracks = np.max(track_idx)+1 if track_idx.size > 0 else 0
+        print('Number of pairwise matches:', edges.shape[1])
+        print('Number of conflicting merges:', uf.n_conflicts)
+        print('Number of tracks:', n_tracks)
+        if n_tracks > 0:
+            print('Mean track length:', np.round(obs_img.shape[0] / n_tracks, 2))
+
+    return track_idx, obs_img, obs_kp